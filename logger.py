@@ -6,7 +6,7 @@ import time
 from enum import IntEnum
 from functools import cache
 
-DEBUG = "debug" in sys.argv
+DEBUG = "--debug" in sys.argv
 
 
 # https://github.com/cmyui/cmyui_pkg/blob/master/cmyui/logging.py#L20-L45
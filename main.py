@@ -1,90 +1,151 @@
 #!/usr/bin/env python3.9
 from __future__ import annotations
 
+import argparse
 import asyncio
+import os
 import traceback
-from collections import defaultdict
+from datetime import datetime
+from typing import AsyncIterator
+from typing import Optional
 
 import logger
 import services
+import settings
 import usecases.beatmap
+import usecases.checkpoint
+import usecases.countries
 import usecases.performance
+import usecases.scores
 import usecases.stats
 from constants.mode import Mode
+from constants.mods import Mods
 from models.beatmap import Beatmap
+from models.checkpoint import Checkpoint
 from models.score import Score
+from models.score_filter import ScoreFilter
+from objects.diff_writer import DiffWriter
 from objects.path import Path
+from objects.pp_writer import PPWriter
+from objects.progress import ProgressTracker
+from objects.recalc_state import RecalcState
+
+
+async def recalculate_scores(
+    score_groups: AsyncIterator[tuple[str, list[Score]]],
+    writer: PPWriter,
+    tracker: ProgressTracker,
+    workers: int = settings.MAP_WORKERS,
+    queue_size: int = settings.MAP_QUEUE_SIZE,
+) -> None:
+    # bounded, so the score source is paused while every worker is busy
+    queue: asyncio.Queue[Optional[tuple[str, list[Score]]]] = asyncio.Queue(
+        maxsize=queue_size,
+    )
+    bmap_count = 0
+    failed_count = 0
 
+    async def map_worker() -> None:
+        nonlocal bmap_count, failed_count
 
-async def get_scores() -> list[Score]:
-    db_scores = []
-
-    for table in ("scores", "scores_relax", "scores_ap"):
-        _db_scores = await services.database.fetch_all(
-            f"SELECT * FROM {table} WHERE completed > 1 AND play_mode != 0 ORDER BY beatmap_md5",  # get all non-failed scores (temp non-std only to fix converts)
-        )
-
-        db_scores.extend(Score.from_dict(db_score) for db_score in _db_scores)
-
-    logger.info(f"Got {len(db_scores):,} scores!")
-    return db_scores
+        while (score_group := await queue.get()) is not None:
+            table, score_list = score_group
 
+            try:
+                beatmap = await usecases.beatmap.fetch_by_md5(score_list[0].map_md5)
+                if beatmap and beatmap.has_leaderboard:
+                    await recalculate_map(beatmap, table, score_list, writer)
+                    bmap_count += 1
+            except Exception:
+                # left unfinished, so no checkpoint can move past this map
+                failed_count += 1
+                logger.error(traceback.format_exc())
+            else:
+                tracker.finish(table, score_list[0].map_md5, len(score_list))
 
-async def recalculate_scores(scores: list[Score]) -> None:
-    # stupid temp shit for memory efficiency
-    _scores: defaultdict[str, list[Score]] = defaultdict(list)
-    bmap_count = len(_scores)
+    worker_tasks = [asyncio.create_task(map_worker()) for _ in range(workers)]
 
-    for score in scores:
-        _scores[score.map_md5].append(score)
+    try:
+        async for table, score_list in score_groups:
+            tracker.start(table, score_list[0].map_md5)
+            await queue.put((table, score_list))
 
-    for beatmap_md5 in list(_scores.keys()):
-        score_list = _scores[beatmap_md5]
+        tracker.exhaust_all()
 
-        beatmap = await usecases.beatmap.fetch_by_md5(beatmap_md5)
-        if not beatmap or not beatmap.has_leaderboard:
-            del _scores[beatmap_md5]
-            continue
+        # one sentinel per worker, queued behind the remaining work
+        for _ in worker_tasks:
+            await queue.put(None)
 
-        del _scores[beatmap_md5]
-        asyncio.create_task(recalculate_map(beatmap, score_list))
+        await asyncio.gather(*worker_tasks)
+    finally:
+        for task in worker_tasks:
+            task.cancel()
 
-    del _scores
     logger.info(f"Calculated scores for {bmap_count:,} beatmaps!")
 
+    if failed_count:
+        raise RuntimeError(f"Failed to recalculate {failed_count:,} beatmaps!")
+
+
+async def save_checkpoint(
+    tracker: ProgressTracker,
+    writer: PPWriter,
+    checkpoint_path: Path,
+) -> None:
+    # snapshot before draining, so every map it covers has its pp written;
+    # if any writes fail, drain raises & the checkpoint isn't saved
+    checkpoint = tracker.snapshot()
+    await writer.drain()
+
+    usecases.checkpoint.save(checkpoint_path, checkpoint)
+
+
+async def save_checkpoints_periodically(
+    tracker: ProgressTracker,
+    writer: PPWriter,
+    checkpoint_path: Path,
+    interval: float,
+) -> None:
+    while True:
+        await asyncio.sleep(interval)
+
+        try:
+            await save_checkpoint(tracker, writer, checkpoint_path)
+        except Exception:
+            logger.error(traceback.format_exc())
+
+
+async def recalculate_map(
+    beatmap: Beatmap,
+    table: str,
+    scores: list[Score],
+    writer: PPWriter,
+) -> None:
+    osu_file_path = usecases.performance.BEATMAPS_DIR / f"{beatmap.id}.osu"
+    if not await usecases.performance.check_local_file(
+        osu_file_path,
+        beatmap.id,
+        beatmap.md5,
+    ):
+        if services.dry_run:
+            return
 
-async def recalculate_map(beatmap: Beatmap, scores: list[Score]) -> None:
-    await asyncio.gather(
-        *[recalculate_score(beatmap, score) for score in scores],
-        return_exceptions=True,
-    )
+        await services.database.execute(
+            f"DELETE FROM {table} WHERE id IN ({','.join(str(score.id) for score in scores)})",
+        )
+        return
 
-    logger.info(f"Completed calculating {beatmap.song_name}!")
-    del beatmap
+    old_pps = {score.id: score.pp for score in scores}
 
+    calculated_scores = await usecases.performance.calculate_scores(
+        scores,
+        osu_file_path,
+    )
 
-async def recalculate_score(beatmap: Beatmap, score: Score) -> None:
-    try:
-        beatmap_path = Path("/home/akatsuki/data/beatmaps")
-        osu_file_path = beatmap_path / f"{beatmap.id}.osu"
-        if not await usecases.performance.check_local_file(
-            osu_file_path,
-            beatmap.id,
-            beatmap.md5,
-        ):
-            await services.database.execute(
-                f"DELETE FROM {score.mode.scores_table} WHERE id = :id",
-                {"id": score.id},
-            )
-            return
+    for score in calculated_scores:
+        await writer.add(table, score, old_pps[score.id])
 
-        usecases.performance.calculate_score(score, osu_file_path)
-        await services.database.execute(
-            f"UPDATE {score.mode.scores_table} SET pp = :pp WHERE id = :id",
-            {"pp": score.pp, "id": score.id},
-        )
-    except Exception:
-        logger.error(traceback.format_exc())
+    logger.info(f"Completed calculating {beatmap.song_name}!")
 
 
 async def recalculate_user(user_id: int, privileges: int) -> None:
@@ -103,7 +164,7 @@ async def recalculate_user(user_id: int, privileges: int) -> None:
             await usecases.stats.update_rank(stats)
 
         # update ingame
-        await usecases.stats.refresh_stats()
+        await usecases.stats.refresh_stats(user_id)
 
         logger.info(
             f"User ID's {mode!r} stats finished recalculating: {old_pp:.2f}pp -> {stats.pp:.2f}pp",
@@ -112,30 +173,394 @@ async def recalculate_user(user_id: int, privileges: int) -> None:
     logger.info(f"Finished recalculating stats for user ID {user_id}")
 
 
-async def main() -> int:
+def build_score_filter(
+    args: argparse.Namespace,
+    state: RecalcState,
+    map_versions: Optional[list[tuple[int, str, int]]],
+) -> ScoreFilter:
+    score_filter = ScoreFilter(
+        since=args.since,
+        until=args.until,
+        shard=args.shard,
+        tables=args.tables,
+        modes=args.modes,
+        user_ids=args.user_ids,
+        map_md5s=args.map_md5s,
+        map_ids=args.map_ids,
+        mods=args.mods,
+    )
+
+    if args.new_scores:
+        score_filter.min_ids = state.watermarks()
+        logger.info(f"Only recalculating scores newer than {score_filter.min_ids}")
+
+    if args.changed_maps:
+        assert map_versions is not None
+        changed_md5s = state.changed_md5s(map_versions)
+
+        # too many to bind into every page's query (e.g. on a first run), and
+        # most beatmaps would match anyway, so just recalculate all of them
+        if len(changed_md5s) > settings.CHANGED_MAPS_FILTER_LIMIT:
+            score_filter.min_ids = None  # which includes every new score
+            logger.info(
+                f"{len(changed_md5s):,} beatmaps changed, recalculating scores on all beatmaps",
+            )
+        else:
+            score_filter.changed_md5s = changed_md5s
+            logger.info(
+                f"Only recalculating scores on {len(changed_md5s):,} changed beatmaps",
+            )
+
+    return score_filter
+
+
+async def run_scores(args: argparse.Namespace) -> None:
+    # per shard, as each shard only covers its own slice of beatmaps
+    state = RecalcState(
+        usecases.checkpoint.shard_path(settings.RECALC_STATE_PATH, args.shard),
+    )
+
+    try:
+        # taken before the run, so changes made during it are picked up next time
+        max_ids = await usecases.scores.fetch_max_ids()
+
+        # loading every beatmap's version is costly, so only do it when needed
+        map_versions = None
+        if args.changed_maps:
+            map_versions = await usecases.scores.fetch_map_versions()
+
+        score_filter = build_score_filter(args, state, map_versions)
+
+        # runs covering every beatmap still record versions for --changed-maps
+        if (
+            map_versions is None
+            and score_filter.covers_changed_maps
+            and not args.dry_run
+        ):
+            map_versions = await usecases.scores.fetch_map_versions()
+
+        checkpoint_path = usecases.checkpoint.checkpoint_path(args.shard)
+
+        checkpoint = None
+        if args.resume:
+            checkpoint = usecases.checkpoint.load(checkpoint_path)
+
+        if checkpoint is None:
+            shard_name = f"{args.shard[0]}/{args.shard[1]}" if args.shard else ""
+            checkpoint = Checkpoint(shard=shard_name)
+
+        tracker = ProgressTracker(checkpoint)
+
+        writer: PPWriter
+        if args.dry_run:
+            writer = DiffWriter(
+                usecases.checkpoint.shard_path(args.diff_output, args.shard),
+                settings.PP_WRITE_BATCH_SIZE,
+                settings.PP_WRITE_FLUSH_INTERVAL,
+                changed_epsilon=settings.PP_WRITE_SKIP_EPSILON,
+            )
+        else:
+            writer = PPWriter(
+                settings.PP_WRITE_BATCH_SIZE,
+                settings.PP_WRITE_FLUSH_INTERVAL,
+                skip_epsilon=settings.PP_WRITE_SKIP_EPSILON,
+            )
+        writer.start()
+
+        checkpoint_task = None
+        if not args.dry_run:
+            checkpoint_task = asyncio.create_task(
+                save_checkpoints_periodically(
+                    tracker,
+                    writer,
+                    checkpoint_path,
+                    settings.CHECKPOINT_INTERVAL,
+                ),
+            )
+
+        try:
+            await recalculate_scores(
+                usecases.scores.stream_all(
+                    checkpoint=checkpoint,
+                    score_filter=score_filter,
+                ),
+                writer,
+                tracker,
+            )
+        finally:
+            if checkpoint_task is not None:
+                checkpoint_task.cancel()
+
+            await writer.close()
+
+            if checkpoint_task is not None:
+                await save_checkpoint(tracker, writer, checkpoint_path)
+
+        # only advance what this run is known to have fully covered
+        if not args.dry_run:
+            if score_filter.covers_new_scores:
+                state.save_watermarks(max_ids)
+
+            if map_versions is not None and score_filter.covers_changed_maps:
+                state.save_map_versions(map_versions)
+    finally:
+        state.close()
+
+    logger.info("Finished recalculating scores")
+    usecases.beatmap.log_cache_stats()
+    logger.info(
+        f"Avoided {usecases.performance.DIFFICULTY_CALCS_AVOIDED:,} difficulty calculations",
+    )
+
+
+async def run_stats(args: argparse.Namespace) -> None:
+    unrestricted_ids = await usecases.stats.fetch_unrestricted_ids()
+    await usecases.countries.preload()
+
+    for table in usecases.scores.SCORES_TABLES:
+        results = await usecases.stats.bulk_recalc(table)
+
+        for mode, user_stats in results.items():
+            updated_ids = await usecases.stats.save_many(
+                mode,
+                user_stats,
+                settings.STATS_WRITE_BATCH_SIZE,
+                settings.PP_WRITE_SKIP_EPSILON,
+            )
+
+            if args.rebuild_leaderboards:
+                await usecases.stats.rebuild_leaderboards(
+                    mode,
+                    {
+                        user_id: pp
+                        for user_id, (pp, _) in user_stats.items()
+                        if user_id in unrestricted_ids and pp > 0
+                    },
+                    settings.LEADERBOARD_CHUNK_SIZE,
+                )
+            else:
+                await usecases.stats.update_leaderboards(
+                    mode,
+                    {
+                        user_id: user_stats.get(user_id, (0.0, 0.0))[0]
+                        for user_id in updated_ids
+                        if user_id in unrestricted_ids
+                    },
+                    settings.LEADERBOARD_CHUNK_SIZE,
+                )
+
+            # update ingame
+            await usecases.stats.refresh_many(
+                updated_ids,
+                settings.LEADERBOARD_CHUNK_SIZE,
+            )
+
+    logger.info("Finished recalculating stats")
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    try:
+        shard, shards = map(int, value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be in the form K/N")
+
+    if not 0 <= shard < shards:
+        raise argparse.ArgumentTypeError("shard must satisfy 0 <= K < N")
+
+    return shard, shards
+
+
+def parse_mode(value: str) -> Mode:
+    try:
+        return Mode[value.upper()]
+    except KeyError:
+        raise argparse.ArgumentTypeError(
+            f"mode must be one of {', '.join(mode.name.lower() for mode in Mode)}",
+        )
+
+
+def parse_mods(value: str) -> int:
+    if value.isdigit():
+        return int(value)
+
+    return int(Mods.convert_str(value))
+
+
+def parse_time(value: str) -> int:
+    if value.isdigit():
+        return int(value)
+
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "time must be a unix timestamp or an ISO 8601 date",
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Mass recalculates scores and users with max efficiency",
+    )
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="scores",
+        choices=("scores", "stats", "build-manifest", "merge-reports"),
+    )
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        help="checkpoint & diff summary files to combine, for merge-reports",
+    )
+    parser.add_argument("--debug", action="store_true")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue from the last checkpoint, rather than starting over",
+    )
+    parser.add_argument(
+        "--new-scores",
+        action="store_true",
+        help="only scores submitted since the last run",
+    )
+    parser.add_argument(
+        "--changed-maps",
+        action="store_true",
+        help="only scores on beatmaps whose md5 or latest_update changed since the last run",
+    )
+    parser.add_argument(
+        "--since",
+        type=parse_time,
+        help="only scores set at or after this unix timestamp or ISO 8601 date",
+    )
+    parser.add_argument(
+        "--until",
+        type=parse_time,
+        help="only scores set before this unix timestamp or ISO 8601 date",
+    )
+    parser.add_argument(
+        "--mode",
+        dest="modes",
+        type=parse_mode,
+        action="append",
+        help="only scores in this mode, e.g. taiko_rx (repeatable)",
+    )
+    parser.add_argument(
+        "--table",
+        dest="tables",
+        choices=usecases.scores.SCORES_TABLES,
+        action="append",
+        help="only scores in this table (repeatable)",
+    )
+    parser.add_argument(
+        "--user",
+        dest="user_ids",
+        type=int,
+        action="append",
+        help="only scores set by this user id (repeatable)",
+    )
+    parser.add_argument(
+        "--map-md5",
+        dest="map_md5s",
+        action="append",
+        help="only scores on this beatmap md5 (repeatable)",
+    )
+    parser.add_argument(
+        "--map-id",
+        dest="map_ids",
+        type=int,
+        action="append",
+        help="only scores on this beatmap id (repeatable)",
+    )
+    parser.add_argument(
+        "--mods",
+        type=parse_mods,
+        help="only scores with all of these mods, as a bitmask or string (e.g. HDDT)",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="K/N: only recalculate the K-th (0-indexed) of N slices of beatmaps",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="write old & new pp to --diff-output, rather than the database",
+    )
+    parser.add_argument(
+        "--diff-output",
+        default=settings.DIFF_OUTPUT_PATH,
+        help="csv, or parquet if it ends in .parquet, for --dry-run",
+    )
+    parser.add_argument(
+        "--report-output",
+        default=settings.REPORT_OUTPUT_PATH,
+        help="where merge-reports saves the combined report, as json",
+    )
+    parser.add_argument(
+        "--rebuild-leaderboards",
+        action="store_true",
+        help="rebuild every redis leaderboard from scratch & swap them in at once, for stats",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="hashing threads for build-manifest",
+    )
+
+    args = parser.parse_args()
+
+    if args.dry_run and args.resume:
+        parser.error("--dry-run runs can't be resumed")
+
+    if args.dry_run and args.command != "scores":
+        parser.error("--dry-run only applies to score recalcs")
+
+    return args
+
+
+async def main(args: argparse.Namespace) -> int:
     exit_code = 0
 
+    if args.command == "build-manifest":
+        usecases.performance.build_manifest(args.threads)
+        return exit_code
+
+    if args.command == "merge-reports":
+        report = usecases.checkpoint.merge([Path(path) for path in args.paths])
+        usecases.checkpoint.save_report(Path(args.report_output), report)
+        return exit_code
+
     usecases.performance.ensure_oppai()
+    usecases.performance.start_executor(settings.CALC_PROCESSES)
+    usecases.performance.open_manifest()
 
-    try:
-        await services.connect_services()
+    if settings.BEATMAP_DISK_CACHE_PATH:
+        usecases.beatmap.open_disk_cache(settings.BEATMAP_DISK_CACHE_PATH)
 
-        scores = await get_scores()
-        await recalculate_scores(scores)
+    services.dry_run = args.dry_run
 
-        logger.info("Finished recalculating scores")
+    try:
+        await services.connect_services()
 
-        # TODO: finish
-        # logger.info("Finished recalculating stats")
+        if args.command == "stats":
+            await run_stats(args)
+        else:
+            await run_scores(args)
     except KeyboardInterrupt:
         exit_code = 0
     except:
         logger.error(traceback.format_exc())
         exit_code = 1
 
+    usecases.performance.stop_executor()
+    usecases.performance.close_manifest()
+    usecases.beatmap.close_disk_cache()
     await services.disconnect_services()
     return exit_code
 
 
 if __name__ == "__main__":
-    raise SystemExit(asyncio.run(main()))
+    raise SystemExit(asyncio.run(main(parse_args())))
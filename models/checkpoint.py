@@ -0,0 +1,37 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from dataclasses import field
+
+
+@dataclass
+class Checkpoint:
+    # scores table -> last beatmap md5 whose pp is fully written back
+    last_md5s: dict[str, str] = field(default_factory=dict)
+    finished_tables: list[str] = field(default_factory=list)
+
+    maps_done: int = 0
+    scores_done: int = 0
+
+    # "K/N" if this run was one shard of a sharded recalc
+    shard: str = ""
+
+    @property
+    def as_dict(self) -> dict:
+        return {
+            "last_md5s": self.last_md5s,
+            "finished_tables": self.finished_tables,
+            "maps_done": self.maps_done,
+            "scores_done": self.scores_done,
+            "shard": self.shard,
+        }
+
+    @classmethod
+    def from_dict(cls, result: dict) -> Checkpoint:
+        return cls(
+            last_md5s=result["last_md5s"],
+            finished_tables=result["finished_tables"],
+            maps_done=result["maps_done"],
+            scores_done=result["scores_done"],
+            shard=result.get("shard", ""),
+        )
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Optional
+
+from constants.mode import Mode
+
+
+@dataclass
+class ScoreFilter:
+    # incremental runs; if both are set, scores matching either are included.
+    # scores table -> only scores with an id above this (or any, if missing)
+    min_ids: Optional[dict[str, int]] = None
+
+    # only scores on beatmaps changed since the last run
+    changed_md5s: Optional[list[str]] = None
+
+    # unix timestamps, compared against the score's `time`
+    since: Optional[int] = None
+    until: Optional[int] = None
+
+    # (index, count); only scores on this node's slice of beatmaps.
+    # not a targeted filter, as each shard keeps its own incremental state
+    shard: Optional[tuple[int, int]] = None
+
+    # targeted recalcs; each is ignored if unset
+    tables: Optional[list[str]] = None
+    modes: Optional[list[Mode]] = None
+    user_ids: Optional[list[int]] = None
+    map_md5s: Optional[list[str]] = None
+    map_ids: Optional[list[int]] = None
+    mods: Optional[int] = None  # scores must have all of these mods
+
+    def includes_table(self, table: str) -> bool:
+        if self.tables is not None and table not in self.tables:
+            return False
+
+        if self.modes is not None and all(
+            mode.scores_table != table for mode in self.modes
+        ):
+            return False
+
+        return True
+
+    @property
+    def targeted(self) -> bool:
+        return (
+            self.since is not None
+            or self.until is not None
+            or self.tables is not None
+            or self.modes is not None
+            or self.user_ids is not None
+            or self.map_md5s is not None
+            or self.map_ids is not None
+            or self.mods is not None
+        )
+
+    @property
+    def covers_new_scores(self) -> bool:
+        """Whether every score newer than the watermarks is included."""
+        return not self.targeted and (
+            self.changed_md5s is None or self.min_ids is not None
+        )
+
+    @property
+    def covers_changed_maps(self) -> bool:
+        """Whether every score on a changed beatmap is included."""
+        return not self.targeted and (
+            self.min_ids is None or self.changed_md5s is not None
+        )
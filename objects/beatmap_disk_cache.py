@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import sqlite3
+import time
+from typing import Optional
+
+import orjson
+
+from models.beatmap import Beatmap
+
+COMMIT_EVERY = 1_000
+
+
+class BeatmapDiskCache:
+    """Persistent store of beatmap rows & unsubmitted md5s, so that
+    repeat recalcs can skip most database & osu! api lookups.
+
+    Beatmap rows expire after `ttl` seconds, so that status changes made
+    in the database (ranking, unranking, freezing) are eventually seen."""
+
+    def __init__(self, db_path: str, ttl: float, unsub_ttl: float) -> None:
+        self.db_path = db_path
+        self.ttl = ttl
+        self.unsub_ttl = unsub_ttl
+
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+
+        # caches from before rows expired have nothing to expire them by
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(beatmaps)")}
+        if columns and "added_at" not in columns:
+            self._conn.execute("DROP TABLE beatmaps")
+
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS beatmaps (md5 TEXT PRIMARY KEY, data BLOB NOT NULL, added_at REAL NOT NULL)",
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS unsubmitted (md5 TEXT PRIMARY KEY, added_at REAL NOT NULL)",
+        )
+        self._uncommitted = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def _wrote(self) -> None:
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_EVERY:
+            self.commit()
+
+    def get(self, md5: str) -> Optional[Beatmap]:
+        row = self._conn.execute(
+            "SELECT data FROM beatmaps WHERE md5 = ? AND added_at > ?",
+            (md5, time.time() - self.ttl),
+        ).fetchone()
+
+        if not row:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return Beatmap.from_dict(orjson.loads(row[0]))
+
+    def save(self, md5: str, beatmap: Beatmap) -> None:
+        self._conn.execute(
+            "REPLACE INTO beatmaps (md5, data, added_at) VALUES (?, ?, ?)",
+            (md5, orjson.dumps(beatmap.db_dict), time.time()),
+        )
+        self._wrote()
+
+    def delete(self, md5: str) -> None:
+        self._conn.execute("DELETE FROM beatmaps WHERE md5 = ?", (md5,))
+        self._wrote()
+
+    def is_unsubmitted(self, md5: str) -> bool:
+        row = self._conn.execute(
+            "SELECT added_at FROM unsubmitted WHERE md5 = ?",
+            (md5,),
+        ).fetchone()
+
+        return row is not None and row[0] > time.time() - self.unsub_ttl
+
+    def add_unsubmitted(self, md5: str) -> None:
+        self._conn.execute(
+            "REPLACE INTO unsubmitted (md5, added_at) VALUES (?, ?)",
+            (md5, time.time()),
+        )
+        self._wrote()
+
+    def commit(self) -> None:
+        self._conn.commit()
+        self._uncommitted = 0
+
+    def close(self) -> None:
+        self.commit()
+        self._conn.close()
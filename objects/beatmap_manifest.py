@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import logger
+from objects.path import Path
+
+COMMIT_EVERY = 1_000
+
+
+class BeatmapManifest:
+    """Persistent (size, mtime) -> md5 index of local .osu files,
+    so unchanged files don't need to be re-hashed between runs."""
+
+    def __init__(self, db_path: str) -> None:
+        self.db_path = db_path
+
+        # used from the default executor's threads, so guarded by a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS manifest ("
+            "path TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+            "mtime_ns INTEGER NOT NULL, md5 TEXT NOT NULL)",
+        )
+        self._uncommitted = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, file_path: str, stat: os.stat_result) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, md5 FROM manifest WHERE path = ?",
+                (file_path,),
+            ).fetchone()
+
+        if not row or (row[0], row[1]) != (stat.st_size, stat.st_mtime_ns):
+            return None
+
+        return row[2]
+
+    def record(self, file_path: str, stat: os.stat_result, md5: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "REPLACE INTO manifest (path, size, mtime_ns, md5) VALUES (?, ?, ?, ?)",
+                (file_path, stat.st_size, stat.st_mtime_ns, md5),
+            )
+
+            self._uncommitted += 1
+            if self._uncommitted >= COMMIT_EVERY:
+                self._conn.commit()
+                self._uncommitted = 0
+
+    def file_md5(self, osu_file_path: Path) -> Optional[str]:
+        """Returns the md5 of the file, only hashing it if it's new or changed.
+        Returns None if the file doesn't exist."""
+
+        file_path = str(osu_file_path)
+
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+
+        if md5 := self.lookup(file_path, stat):
+            self.hits += 1
+            return md5
+
+        self.misses += 1
+
+        with open(file_path, "rb") as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+
+        self.record(file_path, stat, md5)
+        return md5
+
+    def build(self, beatmaps_dir: Path, threads: int) -> None:
+        """Scans every .osu file in `beatmaps_dir`, hashing any new or changed files."""
+
+        osu_file_paths = [
+            Path(entry.path)
+            for entry in os.scandir(str(beatmaps_dir))
+            if entry.is_file() and entry.name.endswith(".osu")
+        ]
+
+        logger.info(f"Scanning {len(osu_file_paths):,} beatmap files")
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for idx, _ in enumerate(executor.map(self.file_md5, osu_file_paths)):
+                if idx and idx % 10_000 == 0:
+                    logger.info(f"Scanned {idx:,} beatmap files")
+
+        self.commit()
+
+        logger.info(
+            f"Built beatmap manifest: {self.hits:,} unchanged, {self.misses:,} hashed",
+        )
+
+    def commit(self) -> None:
+        with self._lock:
+            self._conn.commit()
+            self._uncommitted = 0
+
+    def close(self) -> None:
+        self.commit()
+        self._conn.close()
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Generic
+from typing import Hashable
+from typing import Optional
+from typing import TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """Size-capped mapping which evicts the least recently used key,
+    optionally expiring keys `ttl` seconds after they were set."""
+
+    __slots__ = ("name", "maxsize", "ttl", "_data", "hits", "misses", "evictions")
+
+    def __init__(self, name: str, maxsize: int, ttl: Optional[float] = None) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        # key -> (value, expires_at)
+        self._data: OrderedDict[K, tuple[V, float]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return self._lookup(key) is not None
+
+    def __setitem__(self, key: K, value: V) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else 0.0
+
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def _lookup(self, key: K) -> Optional[tuple[V, float]]:
+        entry = self._data.get(key)
+
+        if entry is not None and self.ttl is not None and entry[1] < time.monotonic():
+            del self._data[key]
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self._lookup(key)
+        return entry[0] if entry is not None else None
+
+    def pop(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        entry = self._data.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> str:
+        return (
+            f"{self.name}: {len(self):,}/{self.maxsize:,} entries, "
+            f"{self.hits:,} hits, {self.misses:,} misses ({self.hit_rate:.1%} hit rate), "
+            f"{self.evictions:,} evictions"
+        )
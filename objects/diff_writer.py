@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+import csv
+import math
+import os
+from collections import Counter
+from collections import defaultdict
+from typing import Any
+from typing import Optional
+
+import orjson
+
+import logger
+from models.score import Score
+from objects.path import Path
+from objects.pp_writer import PPWriter
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # only needed for .parquet output
+    pyarrow = None
+
+COLUMNS = (
+    "table",
+    "score_id",
+    "user_id",
+    "map_md5",
+    "mode",
+    "mods",
+    "old_pp",
+    "new_pp",
+)
+
+# deltas are summarised in buckets this many pp wide, so memory use is bounded
+# by the spread of the deltas rather than the number of scores
+BUCKET_WIDTH = 0.1
+
+
+class DeltaSummary:
+    """Running summary of one mode's pp deltas, with approximate percentiles."""
+
+    __slots__ = (
+        "count",
+        "changed",
+        "total",
+        "min",
+        "max",
+        "old_pp",
+        "new_pp",
+        "buckets",
+    )
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.changed = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.old_pp = 0.0
+        self.new_pp = 0.0
+        self.buckets: Counter[int] = Counter()
+
+    def add(self, old_pp: float, new_pp: float, changed_epsilon: float) -> None:
+        delta = new_pp - old_pp
+
+        self.count += 1
+        self.total += delta
+        self.min = min(self.min, delta)
+        self.max = max(self.max, delta)
+        self.old_pp += old_pp
+        self.new_pp += new_pp
+        self.buckets[math.floor(delta / BUCKET_WIDTH)] += 1
+
+        if abs(delta) > changed_epsilon:
+            self.changed += 1
+
+    def percentile(self, p: float) -> float:
+        """Accurate to within `BUCKET_WIDTH`."""
+
+        target = p * self.count
+        seen = 0
+
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+
+            if seen >= target:
+                midpoint = (bucket + 0.5) * BUCKET_WIDTH
+                return min(max(midpoint, self.min), self.max)
+
+        return self.max
+
+    def merge(self, other: DeltaSummary) -> None:
+        self.count += other.count
+        self.changed += other.changed
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.old_pp += other.old_pp
+        self.new_pp += other.new_pp
+        self.buckets.update(other.buckets)
+
+    @property
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "changed": self.changed,
+            "total": self.total,
+            # json has no infinity, which an empty summary's bounds are
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "old_pp": self.old_pp,
+            "new_pp": self.new_pp,
+            "buckets": {str(bucket): count for bucket, count in self.buckets.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, result: dict) -> DeltaSummary:
+        summary = cls()
+        summary.count = result["count"]
+        summary.changed = result["changed"]
+        summary.total = result["total"]
+        summary.min = result["min"] if result["min"] is not None else math.inf
+        summary.max = result["max"] if result["max"] is not None else -math.inf
+        summary.old_pp = result["old_pp"]
+        summary.new_pp = result["new_pp"]
+        summary.buckets = Counter(
+            {int(bucket): count for bucket, count in result["buckets"].items()},
+        )
+        return summary
+
+
+def summary_path(output_path: str) -> Path:
+    """Where the per-mode summary of a diff is saved, for merge-reports."""
+
+    return Path(f"{os.path.splitext(output_path)[0]}.summary.json")
+
+
+def log_summaries(summaries: dict[str, DeltaSummary]) -> None:
+    for mode, summary in sorted(summaries.items()):
+        if not summary.count:
+            continue
+
+        logger.info(
+            f"{mode}: {summary.count:,} scores, {summary.changed:,} changed, "
+            f"{summary.old_pp:,.0f}pp -> {summary.new_pp:,.0f}pp total, "
+            f"mean delta {summary.total / summary.count:+.2f}pp, "
+            f"min {summary.min:+.2f}, p1 {summary.percentile(0.01):+.2f}, "
+            f"p50 {summary.percentile(0.5):+.2f}, p99 {summary.percentile(0.99):+.2f}, "
+            f"max {summary.max:+.2f}",
+        )
+
+
+class DiffWriter(PPWriter):
+    """Dry-run stand-in for `PPWriter`, which streams each batch of pp
+    changes to a csv (or parquet) file instead of writing to the database,
+    and summarises the deltas per mode once the run is done, saving the
+    summary alongside it. Scores whose pp moved by more than `changed_epsilon`
+    are counted as changed."""
+
+    def __init__(
+        self,
+        output_path: str,
+        batch_size: int,
+        flush_interval: float,
+        changed_epsilon: float,
+    ) -> None:
+        super().__init__(batch_size, flush_interval)
+
+        self.changed_epsilon = changed_epsilon
+
+        self.output_path = output_path
+        self.parquet = output_path.endswith(".parquet")
+
+        if self.parquet and pyarrow is None:
+            raise RuntimeError("pyarrow must be installed for parquet output!")
+
+        self._csv_file: Optional[Any] = None
+        self._csv_writer: Optional[Any] = None
+        self._parquet_writer: Optional[Any] = None
+
+        if not self.parquet:
+            self._csv_file = open(output_path, "w", newline="")
+            self._csv_writer = csv.writer(self._csv_file)
+            self._csv_writer.writerow(COLUMNS)
+
+        self._summaries: defaultdict[str, DeltaSummary] = defaultdict(DeltaSummary)
+
+    async def _write(self, table: str, rows: list[tuple[Score, float]]) -> None:
+        columns: dict[str, list] = {column: [] for column in COLUMNS}
+
+        for score, old_pp in rows:
+            mode = repr(score.mode)
+
+            columns["table"].append(table)
+            columns["score_id"].append(score.id)
+            columns["user_id"].append(score.user_id)
+            columns["map_md5"].append(score.map_md5)
+            columns["mode"].append(mode)
+            columns["mods"].append(score.mods.value)
+            columns["old_pp"].append(old_pp)
+            columns["new_pp"].append(score.pp)
+
+            self._summaries[mode].add(old_pp, score.pp, self.changed_epsilon)
+
+        if self.parquet:
+            # each batch becomes a row group, so rows aren't held in memory
+            batch = pyarrow.table(columns)
+
+            if self._parquet_writer is None:
+                self._parquet_writer = pyarrow.parquet.ParquetWriter(
+                    self.output_path,
+                    batch.schema,
+                )
+
+            self._parquet_writer.write_table(batch)
+        else:
+            assert self._csv_writer is not None
+            self._csv_writer.writerows(zip(*columns.values()))
+
+        self.rows_written += len(rows)
+
+    async def close(self) -> None:
+        await super().close()
+
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+
+        if self._csv_file is not None:
+            self._csv_file.close()
+            self._csv_file = None
+
+        summary_path(self.output_path).write_bytes_atomic(
+            orjson.dumps(
+                {
+                    "deltas": {
+                        mode: summary.as_dict
+                        for mode, summary in self._summaries.items()
+                    },
+                },
+            ),
+        )
+
+        logger.info(f"Wrote pp diff to {self.output_path}")
+        log_summaries(self._summaries)
@@ -261,6 +261,10 @@ class OppaiWrapper:
         #  and will talk to franc[e]sco about it)
         self.static_lib.ezpp_set_nmiss(self._ez, nmiss)
 
+    def set_autocalc(self, autocalc: bool) -> None:
+        # recalculate automatically whenever a parameter is set
+        self.static_lib.ezpp_set_autocalc(self._ez, int(autocalc))
+
     def set_score_version(self, score_version: int) -> None:
         self.static_lib.ezpp_set_score_version(self._ez, score_version)
 
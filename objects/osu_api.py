@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import Counter
+from typing import Any
+from typing import Optional
+
+import aiohttp
+
+import logger
+
+GET_BEATMAPS_URL = "https://old.ppy.sh/api/get_beatmaps"
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second, with bursts of up to `capacity`."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated_at) * self.rate,
+        )
+        self.updated_at = now
+
+    def try_acquire(self) -> bool:
+        self._refill()
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+    def time_until_available(self) -> float:
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class OsuAPIClient:
+    """Shared osu! api (v1) client, rotating between api keys.
+
+    Each key has its own token bucket, in-flight requests are capped, and
+    requests are retried with exponential backoff on 429s, 5xxs & timeouts."""
+
+    def __init__(
+        self,
+        http: aiohttp.ClientSession,
+        api_keys: list[str],
+        rate_per_key: float,
+        max_in_flight: int,
+        max_retries: int,
+    ) -> None:
+        self.http = http
+        self.max_retries = max_retries
+
+        self._buckets = {
+            api_key: TokenBucket(rate_per_key, capacity=max(1.0, rate_per_key))
+            for api_key in api_keys
+        }
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.total_latency = 0.0
+        self.key_usage: Counter[str] = Counter()
+
+    async def _acquire_key(self) -> str:
+        if not self._buckets:
+            raise RuntimeError("No osu! api keys configured!")
+
+        while True:
+            # prefer whichever key has the most headroom
+            for api_key, bucket in sorted(
+                self._buckets.items(),
+                key=lambda item: item[1].tokens,
+                reverse=True,
+            ):
+                if bucket.try_acquire():
+                    return api_key
+
+            await asyncio.sleep(
+                min(bucket.time_until_available() for bucket in self._buckets.values()),
+            )
+
+    async def get_beatmaps(self, params: dict[str, Any]) -> Optional[list[dict]]:
+        """Returns the api's response json, or None if the request failed."""
+
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    self.retries += 1
+                    await asyncio.sleep(0.5 * 2**attempt)
+
+                api_key = await self._acquire_key()
+                self.key_usage[api_key[-4:]] += 1  # don't keep whole keys around
+                self.requests += 1
+
+                started_at = time.perf_counter()
+
+                try:
+                    async with self.http.get(
+                        GET_BEATMAPS_URL,
+                        params={"k": api_key, **params},
+                    ) as response:
+                        if response.status in RETRY_STATUSES:
+                            continue
+
+                        if response.status != 200:
+                            break
+
+                        return await response.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    continue
+                finally:
+                    self.total_latency += time.perf_counter() - started_at
+
+        self.failures += 1
+        return None
+
+    def log_stats(self) -> None:
+        if not self.requests:
+            return
+
+        logger.info(
+            f"osu! api: {self.requests:,} requests, {self.retries:,} retries, "
+            f"{self.failures:,} failures, "
+            f"{self.total_latency / self.requests * 1000:.0f}ms avg latency, "
+            f"key usage: {dict(self.key_usage)}",
+        )
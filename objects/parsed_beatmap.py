@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+from types import TracebackType
+from typing import Optional
+from typing import Type
+
+from rosu_pp_py import Calculator
+
+from objects.oppai import OppaiWrapper
+from objects.path import Path
+
+
+class ParsedBeatmap:
+    """Holds a beatmap's .osu file parsed by rosu and/or oppai, so that
+    many scores can be calculated against it without re-reading the file.
+    Each backend parses lazily, on the first score which needs it."""
+
+    __slots__ = (
+        "osu_file_path",
+        "oppai_lib_path",
+        "_osu_file_contents",
+        "_calculator",
+        "_calculator_loaded",
+        "_ezpp",
+        "_ezpp_state",
+        "oppai_calcs",
+    )
+
+    def __init__(self, osu_file_path: Path, oppai_lib_path: str) -> None:
+        self.osu_file_path = osu_file_path
+        self.oppai_lib_path = oppai_lib_path
+
+        self._osu_file_contents: Optional[bytes] = None
+
+        self._calculator: Optional[Calculator] = None
+        self._calculator_loaded = False
+
+        self._ezpp: Optional[OppaiWrapper] = None
+        # last (mods, nmiss) set on the handle, as changing either forces a re-parse
+        self._ezpp_state: Optional[tuple[int, int]] = None
+        # how many times oppai has had to (re)calculate difficulty
+        self.oppai_calcs = 0
+
+    def __enter__(self) -> ParsedBeatmap:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> bool:
+        self.close()
+        return False
+
+    @property
+    def osu_file_contents(self) -> bytes:
+        if self._osu_file_contents is None:
+            self._osu_file_contents = self.osu_file_path.read_bytes()
+
+        return self._osu_file_contents
+
+    def rosu(self) -> Optional[Calculator]:
+        """Returns the rosu calculator, or None if the .osu file is malformed."""
+
+        if not self._calculator_loaded:
+            self._calculator_loaded = True
+
+            try:
+                self._calculator = Calculator(str(self.osu_file_path))
+            except Exception as e:
+                # messed up .osu file
+                if "osu file format" not in str(e):
+                    raise e
+
+        return self._calculator
+
+    def oppai(self, mods: int, nmiss: int) -> OppaiWrapper:
+        """Returns the oppai handle, configured for `mods` & `nmiss`."""
+
+        if self._ezpp is None:
+            ezpp = OppaiWrapper(self.oppai_lib_path)
+            ezpp.set_static_lib()
+            ezpp.set_autocalc(True)
+
+            # ezpp keeps its own copy of the data, so setters recalculate without file i/o
+            ezpp.calculate_data_dup(self.osu_file_contents)
+            self._ezpp = ezpp
+
+        if self._ezpp_state != (mods, nmiss):
+            self._ezpp.set_mods(mods)
+            self._ezpp.set_nmiss(nmiss)
+            self._ezpp_state = (mods, nmiss)
+            self.oppai_calcs += 1
+
+        return self._ezpp
+
+    def close(self) -> None:
+        if self._ezpp is not None:
+            self._ezpp.free_static_lib()
+            self._ezpp = None
+
+        self._calculator = None
+        self._osu_file_contents = None
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import glob
 import os
+import tempfile
 from typing import Union
 
 
@@ -48,6 +49,21 @@ class Path:
         with open(self._path, "wb") as f:
             f.write(content)
 
+    def write_bytes_atomic(self, content: bytes) -> None:
+        # write to a temp file in the same directory, then rename over the
+        # target, so readers never observe a partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self._path) or ".")
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+
+            os.chmod(tmp_path, 0o644)  # mkstemp creates files as 0600
+            os.replace(tmp_path, self._path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
     def write_text(self, content: str) -> None:
         with open(self._path, "w") as f:
             f.write(content)
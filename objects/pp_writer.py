@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import asyncio
+import time
+import traceback
+from collections import defaultdict
+from typing import Optional
+
+import logger
+import services
+from models.score import Score
+
+
+class PPWriter:
+    """Write-behind buffer for recalculated pp values.
+
+    Results are queued per scores table & written back in batches, either
+    once `batch_size` rows are pending or every `flush_interval` seconds.
+    Scores whose pp moved by no more than `skip_epsilon` aren't written.
+
+    Rows from a failed write are kept & retried by later flushes; `close`
+    raises if any still couldn't be written."""
+
+    def __init__(
+        self,
+        batch_size: int,
+        flush_interval: float,
+        skip_epsilon: Optional[float] = None,
+    ) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.skip_epsilon = skip_epsilon
+
+        # table -> [(score, old pp)]
+        self._pending: defaultdict[str, list[tuple[Score, float]]] = defaultdict(list)
+        self._flush_task: Optional[asyncio.Task] = None
+        self._writes: set[asyncio.Task] = set()
+        self._failing = False
+
+        self.rows_written = 0
+        self.rows_skipped = 0
+        self.failed_writes = 0
+        self.started_at = time.time()
+
+    def start(self) -> None:
+        self.started_at = time.time()
+        self._flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def add(self, table: str, score: Score, old_pp: float) -> None:
+        if (
+            self.skip_epsilon is not None
+            and abs(score.pp - old_pp) <= self.skip_epsilon
+        ):
+            self.rows_skipped += 1
+            return
+
+        pending = self._pending[table]
+        pending.append((score, old_pp))
+
+        # while writes are failing, retries are left to the periodic flush
+        if len(pending) >= self.batch_size and not self._failing:
+            try:
+                await self.flush(table)
+            except Exception:
+                logger.error(traceback.format_exc())
+
+    async def flush(self, table: str) -> None:
+        # swap the buffer out first, so new results aren't held up by the write
+        rows = self._pending.pop(table, None)
+        if not rows:
+            return
+
+        # tracked, so that `drain` can wait for writes started elsewhere
+        write_task = asyncio.create_task(self._write_batch(table, rows))
+        self._writes.add(write_task)
+        write_task.add_done_callback(self._writes.discard)
+
+        # shielded, so cancelling a flush (e.g. the periodic one, on close)
+        # leaves the write running rather than losing the rows it popped
+        await asyncio.shield(write_task)
+
+    async def _write_batch(self, table: str, rows: list[tuple[Score, float]]) -> None:
+        try:
+            await self._write(table, rows)
+        except BaseException:
+            # including cancellation; put back in front of newer rows, to be retried by the next flush
+            self._pending[table][:0] = rows
+            self._failing = True
+            self.failed_writes += 1
+            raise
+
+        self._failing = False
+
+    async def _write(self, table: str, rows: list[tuple[Score, float]]) -> None:
+        params = {}
+        cases = []
+
+        for idx, (score, _) in enumerate(rows):
+            params[f"id{idx}"] = score.id
+            params[f"pp{idx}"] = score.pp
+            cases.append(f"WHEN :id{idx} THEN :pp{idx}")
+
+        # a CASE update, rather than INSERT .. ON DUPLICATE KEY UPDATE,
+        # so scores deleted mid-recalc can't be re-inserted as partial rows
+        await services.database.execute(
+            f"UPDATE {table} SET pp = CASE id {' '.join(cases)} END "
+            f"WHERE id IN ({', '.join(f':id{idx}' for idx in range(len(rows)))})",
+            params,
+        )
+
+        self.rows_written += len(rows)
+
+    async def flush_all(self) -> None:
+        for table in list(self._pending):
+            try:
+                await self.flush(table)
+            except Exception:
+                logger.error(traceback.format_exc())
+
+    async def drain(self) -> None:
+        """Flushes all pending rows, and waits for every write in progress.
+        Raises if any of those writes failed, as their rows aren't written."""
+
+        failed_writes = self.failed_writes
+
+        await self.flush_all()
+
+        if self._writes:
+            await asyncio.wait(self._writes)
+
+        if self.failed_writes > failed_writes:
+            raise RuntimeError(
+                f"{self.failed_writes - failed_writes:,} pp writes failed while draining",
+            )
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush_all()
+
+            logger.debug(
+                f"Wrote {self.rows_written:,} rows ({self.rows_per_second:,.0f}/s)"
+            )
+
+    @property
+    def rows_per_second(self) -> float:
+        elapsed = time.time() - self.started_at
+        return self.rows_written / elapsed if elapsed else 0.0
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        try:
+            await self.drain()
+        finally:
+            logger.info(
+                f"Wrote {self.rows_written:,} pp values ({self.rows_per_second:,.0f} rows/s), "
+                f"skipped {self.rows_skipped:,} unchanged, {self.failed_writes:,} failed writes",
+            )
+
+        if unwritten := sum(len(rows) for rows in self._pending.values()):
+            raise RuntimeError(f"Failed to write {unwritten:,} pp values!")
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import copy
+from collections import deque
+
+from models.checkpoint import Checkpoint
+
+
+class ProgressTracker:
+    """Tracks which beatmaps have finished, per scores table.
+
+    Maps are started in md5 order but may finish out of order, so only the
+    longest finished prefix of each table is safe to resume after."""
+
+    def __init__(self, checkpoint: Checkpoint) -> None:
+        self.checkpoint = checkpoint
+
+        # table -> md5s in the order they were started
+        self._started: dict[str, deque[str]] = {}
+        # table -> finished md5s (& their score counts) still behind an unfinished map
+        self._finished: dict[str, dict[str, int]] = {}
+        self._exhausted: set[str] = set()
+
+    def start(self, table: str, md5: str) -> None:
+        if table not in self._started:
+            # the score source has moved on, so earlier tables have no more maps
+            self._exhausted.update(self._started)
+
+            self._started[table] = deque()
+            self._finished[table] = {}
+
+        self._started[table].append(md5)
+
+    def finish(self, table: str, md5: str, score_count: int) -> None:
+        self._finished[table][md5] = score_count
+
+    def exhaust_all(self) -> None:
+        self._exhausted.update(self._started)
+
+    def snapshot(self) -> Checkpoint:
+        """Advances the checkpoint past every contiguously finished map, and
+        returns a copy of it. Only safe once finished maps' pp is written."""
+
+        for table, started in self._started.items():
+            finished = self._finished[table]
+
+            while started and started[0] in finished:
+                md5 = started.popleft()
+
+                self.checkpoint.last_md5s[table] = md5
+                self.checkpoint.maps_done += 1
+                self.checkpoint.scores_done += finished.pop(md5)
+
+            if (
+                not started
+                and table in self._exhausted
+                and table not in self.checkpoint.finished_tables
+            ):
+                self.checkpoint.finished_tables.append(table)
+
+        return copy.deepcopy(self.checkpoint)
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import sqlite3
+
+
+class RecalcState:
+    """Local record of what previous recalcs have covered, used to
+    select only new scores & changed beatmaps in incremental runs."""
+
+    def __init__(self, db_path: str) -> None:
+        self.db_path = db_path
+
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS watermarks (scores_table TEXT PRIMARY KEY, max_id INTEGER NOT NULL)",
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS beatmaps (beatmap_id INTEGER PRIMARY KEY, "
+            "md5 TEXT NOT NULL, latest_update INTEGER NOT NULL)",
+        )
+
+    def watermarks(self) -> dict[str, int]:
+        return dict(
+            self._conn.execute("SELECT scores_table, max_id FROM watermarks"),
+        )
+
+    def save_watermarks(self, max_ids: dict[str, int]) -> None:
+        with self._conn:
+            self._conn.executemany(
+                "REPLACE INTO watermarks (scores_table, max_id) VALUES (?, ?)",
+                max_ids.items(),
+            )
+
+    def changed_md5s(self, map_versions: list[tuple[int, str, int]]) -> list[str]:
+        """Returns the md5s of beatmaps which are new, or whose md5 or
+        latest_update differ from when `save_map_versions` was last called."""
+
+        known_versions = {
+            beatmap_id: (md5, latest_update)
+            for beatmap_id, md5, latest_update in self._conn.execute(
+                "SELECT beatmap_id, md5, latest_update FROM beatmaps",
+            )
+        }
+
+        return [
+            md5
+            for beatmap_id, md5, latest_update in map_versions
+            if known_versions.get(beatmap_id) != (md5, latest_update)
+        ]
+
+    def save_map_versions(self, map_versions: list[tuple[int, str, int]]) -> None:
+        with self._conn:
+            self._conn.executemany(
+                "REPLACE INTO beatmaps (beatmap_id, md5, latest_update) VALUES (?, ?, ?)",
+                map_versions,
+            )
+
+    def close(self) -> None:
+        self._conn.close()
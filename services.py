@@ -7,6 +7,7 @@ import aioredis
 import databases
 
 import settings
+from objects.osu_api import OsuAPIClient
 
 database = databases.Database(
     "mysql+asyncmy://{user}:{passwd}@{host}:{port}/{name}".format(
@@ -24,18 +25,31 @@ redis: aioredis.Redis = aioredis.Redis(
 )
 
 http: aiohttp.ClientSession
+osu_api: OsuAPIClient
 
 exit_stack = AsyncExitStack()
 
+# set for dry runs, where nothing may be written to the database
+dry_run = False
+
 
 async def connect_services() -> None:
-    global http
+    global http, osu_api
     http = aiohttp.ClientSession()
+    osu_api = OsuAPIClient(
+        http,
+        settings.API_KEYS,
+        rate_per_key=settings.API_RATE_PER_KEY,
+        max_in_flight=settings.API_MAX_IN_FLIGHT,
+        max_retries=settings.API_MAX_RETRIES,
+    )
 
     await exit_stack.enter_async_context(database)
     await exit_stack.enter_async_context(redis)
 
 
 async def disconnect_services() -> None:
+    osu_api.log_stats()
+
     await http.close()
     await exit_stack.aclose()
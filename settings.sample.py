@@ -13,3 +13,29 @@ REDIS_PORT = 6379
 
 # osu!api config
 API_KEYS = []
+API_RATE_PER_KEY = 1.0  # requests per second
+API_MAX_IN_FLIGHT = 16
+API_MAX_RETRIES = 3
+
+# recalc config
+SCORES_PAGE_SIZE = 10_000
+MAP_WORKERS = 16
+MAP_QUEUE_SIZE = 64
+CALC_PROCESSES = 0  # 0 calculates on the event loop
+PP_WRITE_BATCH_SIZE = 5_000
+PP_WRITE_FLUSH_INTERVAL = 5.0  # seconds
+PP_WRITE_SKIP_EPSILON = 0.001  # pp changes no bigger than this aren't written
+BEATMAP_CACHE_SIZE = 50_000
+UNSUB_CACHE_TTL = 60 * 60  # seconds
+BEATMAP_DISK_CACHE_PATH = "beatmaps.cache.db"  # empty to disable
+BEATMAP_DISK_CACHE_TTL = 60 * 60 * 6  # seconds, so status changes are picked up
+BEATMAP_DISK_CACHE_UNSUB_TTL = 60 * 60 * 24 * 7  # seconds
+CHECKPOINT_PATH = "recalc.checkpoint.json"
+CHECKPOINT_INTERVAL = 60.0  # seconds
+RECALC_STATE_PATH = "recalc.state.db"
+CHANGED_MAPS_FILTER_LIMIT = 5_000  # above this, --changed-maps scans every beatmap
+STATS_USERS_PAGE_SIZE = 1_000  # users recalculated per query
+STATS_WRITE_BATCH_SIZE = 1_000
+LEADERBOARD_CHUNK_SIZE = 5_000  # users per redis pipeline
+DIFF_OUTPUT_PATH = "pp_diff.csv"  # .parquet needs pyarrow
+REPORT_OUTPUT_PATH = "recalc_report.json"  # written by merge-reports
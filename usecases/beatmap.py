@@ -1,25 +1,53 @@
 from __future__ import annotations
 
 import asyncio
-import random
 import time
 from typing import Optional
 
+import logger
 import services
 import settings
 from constants.mode import Mode
 from constants.ranked_status import RankedStatus
 from models.beatmap import Beatmap
-
-MD5_CACHE: dict[str, Beatmap] = {}
-UPDATED_CACHE: dict[str, Beatmap] = {}
-UNSUB_CACHE: set[str] = set()
+from objects.beatmap_disk_cache import BeatmapDiskCache
+from objects.cache import LRUCache
+from objects.single_flight import SingleFlight
+
+MD5_CACHE: LRUCache[str, Beatmap] = LRUCache(
+    "MD5_CACHE",
+    maxsize=settings.BEATMAP_CACHE_SIZE,
+)
+UPDATED_CACHE: LRUCache[str, Beatmap] = LRUCache(
+    "UPDATED_CACHE",
+    maxsize=settings.BEATMAP_CACHE_SIZE,
+)
+UNSUB_CACHE: LRUCache[str, bool] = LRUCache(
+    "UNSUB_CACHE",
+    maxsize=settings.BEATMAP_CACHE_SIZE,
+    ttl=settings.UNSUB_CACHE_TTL,
+)
+
+MD5_CHUNK_SIZE = 1_000
+
+# in-flight lookups, so concurrent callers share one db/api request
+MD5_FLIGHTS: SingleFlight[Optional[Beatmap]] = SingleFlight()
+UPDATE_FLIGHTS: SingleFlight[Optional[Beatmap]] = SingleFlight()
+MD5_API_FLIGHTS: SingleFlight[Optional[Beatmap]] = SingleFlight()
+ID_API_FLIGHTS: SingleFlight[Optional[Beatmap]] = SingleFlight()
+
+# optional, persisted between runs
+DISK_CACHE: Optional[BeatmapDiskCache] = None
 
 
 async def update_beatmap(beatmap: Beatmap) -> Optional[Beatmap]:
     if not beatmap.deserves_update:
         return beatmap
 
+    return await UPDATE_FLIGHTS.run(beatmap.md5, lambda: _update_beatmap(beatmap))
+
+
+async def _update_beatmap(beatmap: Beatmap) -> Optional[Beatmap]:
     if updated_beatmap := UPDATED_CACHE.get(beatmap.md5):
         return updated_beatmap
 
@@ -29,18 +57,9 @@ async def update_beatmap(beatmap: Beatmap) -> Optional[Beatmap]:
 
         if new_beatmap.md5 != beatmap.md5:
             # delete any instances of the old map
-            MD5_CACHE.pop(beatmap.md5, None)
+            uncache_beatmap(beatmap.md5)
 
-            await services.database.execute(
-                "DELETE FROM beatmaps WHERE beatmap_md5 = :old_md5",
-                {"old_md5": beatmap.md5},
-            )
-
-            for table in ("scores", "scores_relax", "scores_ap"):
-                await services.database.execute(
-                    f"DELETE FROM {table} WHERE beatmap_md5 = :old_md5",
-                    {"old_md5": beatmap.md5},
-                )
+            await delete_beatmap_scores(beatmap.md5)
 
             if beatmap.frozen:
                 # if the previous version is status frozen, we should force the old status on the new version
@@ -49,16 +68,9 @@ async def update_beatmap(beatmap: Beatmap) -> Optional[Beatmap]:
             UPDATED_CACHE[beatmap.md5] = new_beatmap
     else:
         # it's now unsubmitted!
-        await services.database.execute(
-            "DELETE FROM beatmaps WHERE beatmap_md5 = :old_md5",
-            {"old_md5": beatmap.md5},
-        )
+        uncache_beatmap(beatmap.md5)
 
-        for table in ("scores", "scores_relax", "scores_ap"):
-            await services.database.execute(
-                f"DELETE FROM {table} WHERE beatmap_md5 = :old_md5",
-                {"old_md5": beatmap.md5},
-            )
+        await delete_beatmap_scores(beatmap.md5)
 
         return None
 
@@ -66,35 +78,170 @@ async def update_beatmap(beatmap: Beatmap) -> Optional[Beatmap]:
     new_beatmap.last_update = int(time.time())
 
     asyncio.create_task(save(new_beatmap))  # i don't trust mysql for some reason
-    MD5_CACHE[new_beatmap.md5] = new_beatmap
+    cache_beatmap(new_beatmap.md5, new_beatmap)
 
     return new_beatmap
 
 
+async def delete_beatmap_scores(md5: str) -> None:
+    """Deletes an outdated beatmap version, and every score set on it."""
+
+    if services.dry_run:
+        return
+
+    await services.database.execute(
+        "DELETE FROM beatmaps WHERE beatmap_md5 = :old_md5",
+        {"old_md5": md5},
+    )
+
+    for table in ("scores", "scores_relax", "scores_ap"):
+        await services.database.execute(
+            f"DELETE FROM {table} WHERE beatmap_md5 = :old_md5",
+            {"old_md5": md5},
+        )
+
+
 async def fetch_by_md5(md5: str) -> Optional[Beatmap]:
-    if md5 in UNSUB_CACHE:
+    if is_unsubmitted(md5):
         return None
 
     if beatmap := md5_from_cache(md5):
         return beatmap
 
-    if beatmap := await md5_from_database(md5):
+    return await MD5_FLIGHTS.run(md5, lambda: _fetch_by_md5(md5))
+
+
+async def _fetch_by_md5(md5: str) -> Optional[Beatmap]:
+    if beatmap := await md5_from_disk(md5):
         MD5_CACHE[md5] = beatmap
 
         return beatmap
 
+    if beatmap := await md5_from_database(md5):
+        cache_beatmap(md5, beatmap)
+
+        return beatmap
+
     if beatmap := await md5_from_api(md5):
-        MD5_CACHE[md5] = beatmap
+        cache_beatmap(md5, beatmap)
 
         return beatmap
 
-    UNSUB_CACHE.add(md5)
+    cache_unsubmitted(md5)
+
+
+async def fetch_many_by_md5(md5s: list[str]) -> dict[str, Beatmap]:
+    """Resolves many beatmaps at once; cache misses are loaded from the
+    database in chunks, and only maps missing there go to the osu! api."""
+
+    beatmaps: dict[str, Beatmap] = {}
+    uncached_md5s: list[str] = []
+
+    for md5 in dict.fromkeys(md5s):  # dedupe, keeping order
+        if is_unsubmitted(md5):
+            continue
+
+        if beatmap := md5_from_cache(md5):
+            beatmaps[md5] = beatmap
+        elif beatmap := await md5_from_disk(md5):
+            MD5_CACHE[md5] = beatmap
+            beatmaps[md5] = beatmap
+        else:
+            uncached_md5s.append(md5)
+
+    for idx in range(0, len(uncached_md5s), MD5_CHUNK_SIZE):
+        chunk = uncached_md5s[idx : idx + MD5_CHUNK_SIZE]
+        beatmaps |= await md5s_from_database(chunk)
+
+    api_md5s = [md5 for md5 in uncached_md5s if md5 not in beatmaps]
+    api_beatmaps = await asyncio.gather(*[md5_from_api(md5) for md5 in api_md5s])
+
+    for md5, beatmap in zip(api_md5s, api_beatmaps):
+        if beatmap:
+            beatmaps[md5] = beatmap
+        else:
+            cache_unsubmitted(md5)
+
+    for md5 in uncached_md5s:
+        if beatmap := beatmaps.get(md5):
+            cache_beatmap(md5, beatmap)
+
+    return beatmaps
 
 
 def md5_from_cache(md5: str) -> Optional[Beatmap]:
     return MD5_CACHE.get(md5)
 
 
+def cache_beatmap(md5: str, beatmap: Beatmap) -> None:
+    MD5_CACHE[md5] = beatmap
+
+    if DISK_CACHE is not None:
+        DISK_CACHE.save(md5, beatmap)
+
+
+def uncache_beatmap(md5: str) -> None:
+    MD5_CACHE.pop(md5, None)
+
+    if DISK_CACHE is not None:
+        DISK_CACHE.delete(md5)
+
+
+def is_unsubmitted(md5: str) -> bool:
+    if md5 in UNSUB_CACHE:
+        return True
+
+    if DISK_CACHE is not None and DISK_CACHE.is_unsubmitted(md5):
+        UNSUB_CACHE[md5] = True
+        return True
+
+    return False
+
+
+def cache_unsubmitted(md5: str) -> None:
+    UNSUB_CACHE[md5] = True
+
+    if DISK_CACHE is not None:
+        DISK_CACHE.add_unsubmitted(md5)
+
+
+def open_disk_cache(db_path: str) -> None:
+    global DISK_CACHE
+    DISK_CACHE = BeatmapDiskCache(
+        db_path,
+        ttl=settings.BEATMAP_DISK_CACHE_TTL,
+        unsub_ttl=settings.BEATMAP_DISK_CACHE_UNSUB_TTL,
+    )
+
+
+def close_disk_cache() -> None:
+    global DISK_CACHE
+
+    if DISK_CACHE is not None:
+        DISK_CACHE.close()
+        DISK_CACHE = None
+
+
+def log_cache_stats() -> None:
+    for cache in (MD5_CACHE, UPDATED_CACHE, UNSUB_CACHE):
+        logger.info(cache.stats())
+
+    if DISK_CACHE is not None:
+        logger.info(
+            f"DISK_CACHE: {DISK_CACHE.hits:,} hits, {DISK_CACHE.misses:,} misses",
+        )
+
+
+async def md5_from_disk(md5: str) -> Optional[Beatmap]:
+    if DISK_CACHE is None:
+        return None
+
+    if not (bmap := DISK_CACHE.get(md5)):
+        return None
+
+    return await update_beatmap(bmap)
+
+
 async def md5_from_database(md5: str) -> Optional[Beatmap]:
     db_result = await services.database.fetch_one(
         "SELECT * FROM beatmaps WHERE beatmap_md5 = :md5",
@@ -108,10 +255,33 @@ async def md5_from_database(md5: str) -> Optional[Beatmap]:
     return await update_beatmap(bmap)
 
 
-GET_BEATMAP_URL = "https://old.ppy.sh/api/get_beatmaps"
+async def md5s_from_database(md5s: list[str]) -> dict[str, Beatmap]:
+    db_results = await services.database.fetch_all(
+        "SELECT * FROM beatmaps WHERE beatmap_md5 IN ({})".format(
+            ", ".join(f":md5_{idx}" for idx in range(len(md5s))),
+        ),
+        {f"md5_{idx}": md5 for idx, md5 in enumerate(md5s)},
+    )
+
+    db_beatmaps = [Beatmap.from_dict(db_result) for db_result in db_results]
+    updated_beatmaps = await asyncio.gather(
+        *[update_beatmap(bmap) for bmap in db_beatmaps],
+    )
+
+    return {
+        bmap.md5: beatmap
+        for bmap, beatmap in zip(db_beatmaps, updated_beatmaps)
+        if beatmap
+    }
 
 
 async def save(beatmap: Beatmap) -> None:
+    if DISK_CACHE is not None:
+        DISK_CACHE.save(beatmap.md5, beatmap)
+
+    if services.dry_run:
+        return
+
     await services.database.execute(
         (
             "REPLACE INTO beatmaps (beatmap_id, beatmapset_id, beatmap_md5, song_name, ar, od, mode, rating, "
@@ -125,18 +295,13 @@ async def save(beatmap: Beatmap) -> None:
 
 
 async def md5_from_api(md5: str) -> Optional[Beatmap]:
-    api_key = random.choice(settings.API_KEYS)
+    return await MD5_API_FLIGHTS.run(md5, lambda: _md5_from_api(md5))
 
-    async with services.http.get(
-        GET_BEATMAP_URL,
-        params={"k": api_key, "h": md5},
-    ) as response:
-        if not response or response.status != 200:
-            return None
 
-        response_json = await response.json()
-        if not response_json:
-            return None
+async def _md5_from_api(md5: str) -> Optional[Beatmap]:
+    response_json = await services.osu_api.get_beatmaps({"h": md5})
+    if not response_json:
+        return None
 
     beatmaps = parse_from_osu_api(response_json)
 
@@ -149,18 +314,13 @@ async def md5_from_api(md5: str) -> Optional[Beatmap]:
 
 
 async def id_from_api(id: int) -> Optional[Beatmap]:
-    api_key = random.choice(settings.API_KEYS)
-
-    async with services.http.get(
-        GET_BEATMAP_URL,
-        params={"k": api_key, "b": id},
-    ) as response:
-        if not response or response.status != 200:
-            return None
-
-        response_json = await response.json()
-        if not response_json:
-            return None
+    return await ID_API_FLIGHTS.run(id, lambda: _id_from_api(id))
+
+
+async def _id_from_api(id: int) -> Optional[Beatmap]:
+    response_json = await services.osu_api.get_beatmaps({"b": id})
+    if not response_json:
+        return None
 
     beatmaps = parse_from_osu_api(response_json)
 
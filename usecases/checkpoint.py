@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import os
+from collections import defaultdict
+from typing import Optional
+
+import orjson
+
+import logger
+import settings
+from models.checkpoint import Checkpoint
+from objects.diff_writer import DeltaSummary
+from objects.diff_writer import log_summaries
+from objects.path import Path
+
+
+def shard_path(path: str, shard: Optional[tuple[int, int]]) -> str:
+    if shard is None:
+        return path
+
+    # shards keep separate files, in case they share a filesystem
+    base_path, ext = os.path.splitext(path)
+    return f"{base_path}.{shard[0]}-of-{shard[1]}{ext}"
+
+
+def checkpoint_path(shard: Optional[tuple[int, int]]) -> Path:
+    return Path(shard_path(settings.CHECKPOINT_PATH, shard))
+
+
+def load(checkpoint_path: Path) -> Optional[Checkpoint]:
+    if not checkpoint_path.exists():
+        return None
+
+    checkpoint = Checkpoint.from_dict(orjson.loads(checkpoint_path.read_bytes()))
+
+    logger.info(
+        f"Resuming from checkpoint: {checkpoint.maps_done:,} maps & "
+        f"{checkpoint.scores_done:,} scores already done",
+    )
+    return checkpoint
+
+
+def save(checkpoint_path: Path, checkpoint: Checkpoint) -> None:
+    checkpoint_path.write_bytes_atomic(orjson.dumps(checkpoint.as_dict))
+
+    logger.debug(
+        f"Saved checkpoint: {checkpoint.maps_done:,} maps, {checkpoint.scores_done:,} scores",
+    )
+
+
+def merge(report_paths: list[Path]) -> dict:
+    """Combines the checkpoints & dry-run diff summaries of a sharded recalc
+    into one report."""
+
+    checkpoints: list[Checkpoint] = []
+    summaries: defaultdict[str, DeltaSummary] = defaultdict(DeltaSummary)
+
+    for report_path in report_paths:
+        report = orjson.loads(report_path.read_bytes())
+
+        if "deltas" in report:  # saved by a dry run's diff writer
+            for mode, summary in report["deltas"].items():
+                summaries[mode].merge(DeltaSummary.from_dict(summary))
+        else:
+            checkpoints.append(Checkpoint.from_dict(report))
+
+    merged = Checkpoint(
+        # a table is only done once every shard has finished it
+        finished_tables=(
+            [
+                table
+                for table in checkpoints[0].finished_tables
+                if all(
+                    table in checkpoint.finished_tables for checkpoint in checkpoints
+                )
+            ]
+            if checkpoints
+            else []
+        ),
+        maps_done=sum(checkpoint.maps_done for checkpoint in checkpoints),
+        scores_done=sum(checkpoint.scores_done for checkpoint in checkpoints),
+    )
+
+    for checkpoint in checkpoints:
+        logger.info(
+            f"Shard {checkpoint.shard or '?'}: {checkpoint.maps_done:,} maps, "
+            f"{checkpoint.scores_done:,} scores, finished tables: "
+            f"{', '.join(checkpoint.finished_tables) or 'none'}",
+        )
+
+    if checkpoints:
+        logger.info(
+            f"{len(checkpoints)} shards: {merged.maps_done:,} maps & "
+            f"{merged.scores_done:,} scores recalculated, finished tables: "
+            f"{', '.join(merged.finished_tables) or 'none'}",
+        )
+
+    log_summaries(summaries)
+
+    return {
+        "checkpoint": merged.as_dict,
+        # still mergeable, with the percentiles added for readers
+        "deltas": {
+            mode: summary.as_dict
+            | (
+                {
+                    "p1": summary.percentile(0.01),
+                    "p50": summary.percentile(0.5),
+                    "p99": summary.percentile(0.99),
+                }
+                if summary.count
+                else {}
+            )
+            for mode, summary in summaries.items()
+        },
+    }
+
+
+def save_report(report_path: Path, report: dict) -> None:
+    report_path.write_bytes_atomic(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+
+    logger.info(f"Saved merged report to {report_path}")
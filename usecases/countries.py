@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import asyncio
+import sys
 
 import logger
 import services
@@ -24,3 +25,33 @@ async def get_country(user_id: int) -> str:
 
     COUNTRIES[user_id] = country
     return country
+
+
+async def preload() -> None:
+    """Loads every user's country in one pass, replacing what's cached.
+    Can be called again to pick up changes."""
+
+    global COUNTRIES
+
+    countries: dict[int, str] = {}
+
+    async for row in services.database.iterate("SELECT id, country FROM users_stats"):
+        # interned, so each of the ~250 countries is only stored once
+        countries[row["id"]] = sys.intern(row["country"] or "XX")
+
+    COUNTRIES = countries
+
+    logger.info(
+        f"Preloaded countries for {len(countries):,} users "
+        f"(~{countries_memory_usage() / 1024 / 1024:,.1f}MiB)",
+    )
+
+
+def countries_memory_usage() -> int:
+    """Approximate size of the country cache, in bytes."""
+
+    return (
+        sys.getsizeof(COUNTRIES)
+        + sum(sys.getsizeof(user_id) for user_id in COUNTRIES)
+        + sum(sys.getsizeof(country) for country in set(COUNTRIES.values()))
+    )
@@ -1,22 +1,46 @@
 from __future__ import annotations
 
+import asyncio
 import hashlib
 import math
 import os
+import traceback
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
 
-from rosu_pp_py import Calculator
 from rosu_pp_py import ScoreParams
 
 import logger
 import services
 from constants.mode import Mode
 from models.score import Score
+from objects.beatmap_manifest import BeatmapManifest
 from objects.oppai import OppaiWrapper
+from objects.parsed_beatmap import ParsedBeatmap
 from objects.path import Path
+from objects.single_flight import SingleFlight
 
 OPPAI_DIR = Path.cwd() / "akatsuki-pp"
 OPPAI_LIB = OPPAI_DIR / "liboppai.so"
 
+BEATMAPS_DIR = Path("/home/akatsuki/data/beatmaps")
+MANIFEST_PATH = f"{BEATMAPS_DIR}.manifest.db"
+
+# (mode, mods, max_combo, score, acc, nmiss)
+PerformanceArgs = tuple[Mode, int, int, int, float, int]
+
+CALC_BATCH_SIZE = 1_000
+
+EXECUTOR: Optional[ProcessPoolExecutor] = None
+
+FILE_CHECKS: SingleFlight[bool] = SingleFlight()
+VERIFIED_FILES: set[str] = set()
+
+MANIFEST: Optional[BeatmapManifest] = None
+
+DIFFICULTY_CALCS_AVOIDED = 0
+
 
 def ensure_oppai() -> None:
     if not OPPAI_DIR.exists():
@@ -31,50 +55,98 @@ def ensure_oppai() -> None:
 
 
 async def check_local_file(osu_file_path: Path, map_id: int, map_md5: str) -> bool:
-    if (
-        not osu_file_path.exists()
-        or hashlib.md5(osu_file_path.read_bytes()).hexdigest() != map_md5
-    ):
+    if map_md5 in VERIFIED_FILES:
+        return True
+
+    # coalesce concurrent checks of the same map
+    result = await FILE_CHECKS.run(
+        map_md5,
+        lambda: _check_local_file(osu_file_path, map_id, map_md5),
+    )
+
+    if result:
+        VERIFIED_FILES.add(map_md5)
+
+    return result
+
+
+def open_manifest() -> None:
+    global MANIFEST
+    MANIFEST = BeatmapManifest(MANIFEST_PATH)
+
+
+def close_manifest() -> None:
+    global MANIFEST
+
+    if MANIFEST is not None:
+        logger.info(
+            f"Beatmap manifest: {MANIFEST.hits:,} files unchanged, {MANIFEST.misses:,} hashed",
+        )
+
+        MANIFEST.close()
+        MANIFEST = None
+
+
+def build_manifest(threads: int) -> None:
+    manifest = BeatmapManifest(MANIFEST_PATH)
+
+    try:
+        manifest.build(BEATMAPS_DIR, threads)
+    finally:
+        manifest.close()
+
+
+def _file_md5(osu_file_path: Path) -> Optional[str]:
+    if MANIFEST is not None:
+        return MANIFEST.file_md5(osu_file_path)
+
+    if not osu_file_path.exists():
+        return None
+
+    return hashlib.md5(osu_file_path.read_bytes()).hexdigest()
+
+
+def _save_file(osu_file_path: Path, osu_file_contents: bytes) -> None:
+    osu_file_path.write_bytes_atomic(osu_file_contents)
+
+    if MANIFEST is not None:
+        MANIFEST.record(
+            str(osu_file_path),
+            os.stat(str(osu_file_path)),
+            hashlib.md5(osu_file_contents).hexdigest(),
+        )
+
+
+async def _check_local_file(osu_file_path: Path, map_id: int, map_md5: str) -> bool:
+    if await asyncio.to_thread(_file_md5, osu_file_path) != map_md5:
         async with services.http.get(
             f"https://old.ppy.sh/osu/{map_id}",
         ) as response:
             if response.status != 200:
                 return False
 
-            osu_file_path.write_bytes(await response.read())
+            osu_file_contents = await response.read()
+
+        await asyncio.to_thread(_save_file, osu_file_path, osu_file_contents)
 
     return True
 
 
 def calculate_oppai(
-    mode: Mode,
     mods: int,
     max_combo: int,
     acc: float,
     nmiss: int,
-    osu_file_path: Path,
+    beatmap: ParsedBeatmap,
 ) -> tuple[float, float]:
-    with OppaiWrapper(str(OPPAI_LIB)) as ezpp:
-        ezpp.configure(
-            mode=mode.as_vn,
-            acc=acc,
-            mods=mods,
-            combo=max_combo,
-            nmiss=nmiss,
-        )
-        ezpp.calculate(str(osu_file_path))
+    ezpp = beatmap.oppai(mods, nmiss)
 
-        pp = ezpp.get_pp()
-        sr = ezpp.get_sr()
+    # the handle is reused between scores, so (unlike `configure`)
+    # unset values must be reset to oppai's defaults explicitly
+    ezpp.set_combo(max_combo or -1)
+    ezpp.set_accuracy_percent(acc or -1)
 
-        for _attr in (
-            pp,
-            sr,
-        ):
-            if math.isinf(_attr) or math.isnan(_attr):
-                return (0.0, 0.0)
-
-        return (round(pp, 2), round(sr, 2))
+    return _finite_result(ezpp.get_pp(), ezpp.get_sr())
 
 
 def calculate_rosu(
@@ -84,16 +156,11 @@ def calculate_rosu(
     score: int,
     acc: float,
     nmiss: int,
-    osu_file_path: Path,
+    beatmap: ParsedBeatmap,
 ) -> tuple[float, float]:
-    try:
-        calculator = Calculator(str(osu_file_path))
-    except Exception as e:
-        # messed up .osu file
-        if "osu file format" in str(e):
-            return (0.0, 0.0)
-
-        raise e
+    calculator = beatmap.rosu()
+    if calculator is None:
+        return (0.0, 0.0)
 
     params = ScoreParams(
         mode=mode.as_vn,
@@ -106,14 +173,52 @@ def calculate_rosu(
 
     (res,) = calculator.calculate(params)
 
+    return _finite_result(res.pp, res.stars)
+
+
+def calculate_rosu_many(
+    mode: Mode,
+    mods: int,
+    batch: list[PerformanceArgs],
+    beatmap: ParsedBeatmap,
+) -> list[tuple[float, float]]:
+    """Calculates scores which share a mode & mods in a single call, letting
+    rosu compute their difficulty attributes once and reuse them."""
+
+    calculator = beatmap.rosu()
+    if calculator is None:
+        return [(0.0, 0.0)] * len(batch)
+
+    results = calculator.calculate(
+        [
+            ScoreParams(
+                mode=mode.as_vn,
+                mods=mods,
+                combo=max_combo,
+                score=score,
+                acc=acc,
+                nMisses=nmiss,
+            )
+            for (_, _, max_combo, score, acc, nmiss) in batch
+        ],
+    )
+
+    return [_finite_result(res.pp, res.stars) for res in results]
+
+
+def _finite_result(pp: float, sr: float) -> tuple[float, float]:
     for _attr in (
-        res.pp,
-        res.stars,
+        pp,
+        sr,
     ):
         if math.isinf(_attr) or math.isnan(_attr):
             return (0.0, 0.0)
 
-    return (round(res.pp, 2), round(res.stars, 2))
+    return (round(pp, 2), round(sr, 2))
+
+
+def uses_oppai(mode: Mode) -> bool:
+    return (mode.relax or mode.autopilot) and mode.as_vn == 0
 
 
 def calculate_performance(
@@ -123,21 +228,138 @@ def calculate_performance(
     score: int,
     acc: float,
     nmiss: int,
-    osu_file_path: Path,
+    beatmap: ParsedBeatmap,
 ) -> tuple[float, float]:
-    if (mode.relax or mode.autopilot) and mode.as_vn == 0:
-        return calculate_oppai(mode, mods, max_combo, acc, nmiss, osu_file_path)
+    if uses_oppai(mode):
+        return calculate_oppai(mods, max_combo, acc, nmiss, beatmap)
     else:
-        return calculate_rosu(mode, mods, max_combo, score, acc, nmiss, osu_file_path)
-
-
-def calculate_score(score: Score, osu_file_path: Path) -> None:
-    score.pp, score.sr = calculate_performance(
-        score.mode,
-        score.mods.value,
-        score.max_combo,
-        score.score,
-        score.acc,
-        score.nmiss,
-        osu_file_path,
-    )
+        return calculate_rosu(mode, mods, max_combo, score, acc, nmiss, beatmap)
+
+
+def _init_worker() -> None:
+    # load oppai once per process, rather than on the first score it sees
+    OppaiWrapper.load_static_library(str(OPPAI_LIB))
+
+
+def start_executor(processes: int) -> None:
+    global EXECUTOR
+
+    if processes <= 0:
+        return
+
+    EXECUTOR = ProcessPoolExecutor(max_workers=processes, initializer=_init_worker)
+    logger.info(f"Started {processes} calculation processes")
+
+
+def stop_executor() -> None:
+    global EXECUTOR
+
+    if EXECUTOR is not None:
+        EXECUTOR.shutdown(wait=True)
+        EXECUTOR = None
+
+
+def calculate_batch(
+    batch: list[PerformanceArgs],
+    osu_file_path: str,
+) -> tuple[list[Optional[tuple[float, float]]], int]:
+    """Calculates a batch of scores on the same beatmap. Returns the results,
+    and how many difficulty calculations were avoided by sharing them."""
+
+    # NOTE: runs inside the process pool, so must stay picklable & module-level
+    results: list[Optional[tuple[float, float]]] = [None] * len(batch)
+
+    # scores with the same mode & mods have identical difficulty attributes
+    groups: defaultdict[tuple[Mode, int], list[int]] = defaultdict(list)
+    for idx, args in enumerate(batch):
+        groups[(args[0], args[1])].append(idx)
+
+    difficulty_calcs = 0
+
+    # the map is parsed once per batch, and reused by every score in it
+    with ParsedBeatmap(Path(osu_file_path), str(OPPAI_LIB)) as beatmap:
+        for (mode, mods), indices in groups.items():
+            if not uses_oppai(mode):
+                try:
+                    group_results = calculate_rosu_many(
+                        mode,
+                        mods,
+                        [batch[idx] for idx in indices],
+                        beatmap,
+                    )
+                except Exception:
+                    logger.error(traceback.format_exc())
+                else:
+                    difficulty_calcs += 1
+
+                    for idx, result in zip(indices, group_results):
+                        results[idx] = result
+
+                    continue
+
+            # oppai, or rosu failed as a group; calculate the scores individually
+            for idx in indices:
+                try:
+                    results[idx] = calculate_performance(*batch[idx], beatmap)
+                except Exception:
+                    logger.error(traceback.format_exc())
+
+                if not uses_oppai(mode):
+                    difficulty_calcs += 1
+
+        difficulty_calcs += beatmap.oppai_calcs
+
+    return results, len(batch) - difficulty_calcs
+
+
+async def calculate_scores(scores: list[Score], osu_file_path: Path) -> list[Score]:
+    """Calculates pp & sr for `scores`, all of which are on the same beatmap.
+    Returns the scores which were successfully calculated."""
+
+    # grouping by mods & misses lets oppai skip most of its re-parses
+    scores = sorted(scores, key=lambda score: (score.mode, score.mods, score.nmiss))
+
+    score_args: list[PerformanceArgs] = [
+        (
+            score.mode,
+            score.mods.value,
+            score.max_combo,
+            score.score,
+            score.acc,
+            score.nmiss,
+        )
+        for score in scores
+    ]
+
+    if EXECUTOR is not None:
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    EXECUTOR,
+                    calculate_batch,
+                    score_args[i : i + CALC_BATCH_SIZE],
+                    str(osu_file_path),
+                )
+                for i in range(0, len(score_args), CALC_BATCH_SIZE)
+            ],
+        )
+    else:
+        results = [calculate_batch(score_args, str(osu_file_path))]
+
+    global DIFFICULTY_CALCS_AVOIDED
+    DIFFICULTY_CALCS_AVOIDED += sum(avoided for _, avoided in results)
+
+    calculated_scores = []
+
+    for score, result in zip(
+        scores,
+        (result for batch_results, _ in results for result in batch_results),
+    ):
+        if result is None:
+            continue
+
+        score.pp, score.sr = result
+        calculated_scores.append(score)
+
+    return calculated_scores
@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+from typing import AsyncIterator
+from typing import Optional
+
+import logger
+import services
+import settings
+import usecases.beatmap
+from models.checkpoint import Checkpoint
+from models.score import Score
+from models.score_filter import ScoreFilter
+
+SCORES_TABLES = ("scores", "scores_relax", "scores_ap")
+
+MAX_SCORE_ID = 2**63 - 1
+
+
+def shard_bounds(shard: int, shards: int) -> tuple[str, Optional[str]]:
+    """Returns the [lower, upper) md5 range of a shard. md5s are uniformly
+    distributed, so splitting their keyspace evenly gives balanced shards,
+    which (unlike hashing in sql) can still be scanned by index range."""
+
+    lower = f"{shard * 2**32 // shards:08x}"
+    upper = f"{(shard + 1) * 2**32 // shards:08x}" if shard + 1 < shards else None
+    return lower, upper
+
+
+def _in_list(column: str, values: list, params: dict, name: str = "") -> str:
+    name = name or column
+    placeholders = []
+
+    for idx, value in enumerate(values):
+        params[f"{name}_{idx}"] = value
+        placeholders.append(f":{name}_{idx}")
+
+    return f"{column} IN ({', '.join(placeholders)})"
+
+
+def filter_conditions(score_filter: ScoreFilter, table: str) -> tuple[str, dict]:
+    """Compiles `score_filter` into WHERE conditions for `table`."""
+
+    conditions = ["completed > 1"]  # get all non-failed scores
+    params: dict = {}
+
+    if score_filter.modes is not None:
+        conditions.append(
+            _in_list(
+                "play_mode",
+                [
+                    mode.as_vn
+                    for mode in score_filter.modes
+                    if mode.scores_table == table
+                ],
+                params,
+            ),
+        )
+    else:
+        conditions.append("play_mode != 0")  # temp non-std only to fix converts
+
+    # either new scores or scores on changed beatmaps, so an incremental
+    # run with both covers everything that changed since the last one
+    incremental = []
+
+    if score_filter.min_ids is not None:
+        incremental.append("id > :min_id")
+        params["min_id"] = score_filter.min_ids.get(table, 0)
+
+    if score_filter.changed_md5s:  # none changed matches nothing
+        incremental.append(
+            _in_list("beatmap_md5", score_filter.changed_md5s, params, "changed_md5"),
+        )
+
+    if incremental:
+        conditions.append(f"({' OR '.join(incremental)})")
+
+    if score_filter.since is not None:
+        conditions.append("time >= :since")
+        params["since"] = score_filter.since
+
+    if score_filter.until is not None:
+        conditions.append("time < :until")
+        params["until"] = score_filter.until
+
+    if score_filter.user_ids is not None:
+        conditions.append(_in_list("userid", score_filter.user_ids, params))
+
+    if score_filter.map_md5s is not None:
+        conditions.append(_in_list("beatmap_md5", score_filter.map_md5s, params))
+
+    if score_filter.map_ids is not None:
+        conditions.append(
+            "beatmap_md5 IN (SELECT beatmap_md5 FROM beatmaps WHERE {})".format(
+                _in_list("beatmap_id", score_filter.map_ids, params),
+            ),
+        )
+
+    if score_filter.mods is not None:
+        conditions.append("mods & :mods = :mods")
+        params["mods"] = score_filter.mods
+
+    if score_filter.shard is not None:
+        shard_lower, shard_upper = shard_bounds(*score_filter.shard)
+
+        conditions.append("beatmap_md5 >= :shard_lower")
+        params["shard_lower"] = shard_lower
+
+        if shard_upper is not None:
+            conditions.append("beatmap_md5 < :shard_upper")
+            params["shard_upper"] = shard_upper
+
+    return " AND ".join(conditions), params
+
+
+async def fetch_page(
+    table: str,
+    last_md5: str,
+    last_id: int,
+    page_size: int,
+    score_filter: ScoreFilter,
+) -> list[Score]:
+    conditions, params = filter_conditions(score_filter, table)
+
+    # keyset pagination over (beatmap_md5, id), so each page is an index range scan
+    db_scores = await services.database.fetch_all(
+        f"SELECT * FROM {table} WHERE {conditions} "
+        "AND (beatmap_md5 > :last_md5 OR (beatmap_md5 = :last_md5 AND id > :last_id)) "
+        "ORDER BY beatmap_md5, id LIMIT :limit",
+        {"last_md5": last_md5, "last_id": last_id, "limit": page_size, **params},
+    )
+
+    return [Score.from_dict(db_score) for db_score in db_scores]
+
+
+async def fetch_max_ids() -> dict[str, int]:
+    return {
+        table: await services.database.fetch_val(f"SELECT MAX(id) FROM {table}") or 0
+        for table in SCORES_TABLES
+    }
+
+
+async def fetch_map_versions() -> list[tuple[int, str, int]]:
+    db_beatmaps = await services.database.fetch_all(
+        "SELECT beatmap_id, beatmap_md5, latest_update FROM beatmaps",
+    )
+
+    return [
+        (
+            db_beatmap["beatmap_id"],
+            db_beatmap["beatmap_md5"],
+            db_beatmap["latest_update"],
+        )
+        for db_beatmap in db_beatmaps
+    ]
+
+
+async def stream_table(
+    table: str,
+    page_size: int = settings.SCORES_PAGE_SIZE,
+    after_md5: str = "",
+    score_filter: Optional[ScoreFilter] = None,
+) -> AsyncIterator[list[Score]]:
+    """Yields every score in `table`, grouped by beatmap md5, one page at a time.
+    If `after_md5` is given, only beatmaps sorting after it are included."""
+
+    if score_filter is None:
+        score_filter = ScoreFilter()
+
+    if (
+        score_filter.map_md5s == []
+        or (score_filter.changed_md5s == [] and score_filter.min_ids is None)
+        or not score_filter.includes_table(table)
+    ):
+        return  # nothing can match
+
+    last_md5 = after_md5
+    last_id = MAX_SCORE_ID if after_md5 else 0
+    score_count = 0
+
+    # a beatmap's scores may span multiple pages, so the last
+    # group of a page is held back until we know it's complete
+    pending: list[Score] = []
+
+    while True:
+        page = await fetch_page(table, last_md5, last_id, page_size, score_filter)
+        if not page:
+            break
+
+        score_count += len(page)
+        last_md5, last_id = page[-1].map_md5, page[-1].id
+
+        # resolve the page's beatmaps in bulk, so map workers hit the cache
+        await usecases.beatmap.fetch_many_by_md5([score.map_md5 for score in page])
+
+        for score in page:
+            if pending and pending[0].map_md5 != score.map_md5:
+                yield pending
+                pending = []
+
+            pending.append(score)
+
+        if len(page) < page_size:
+            break
+
+    if pending:
+        yield pending
+
+    logger.info(f"Got {score_count:,} scores from {table}!")
+
+
+async def stream_all(
+    page_size: int = settings.SCORES_PAGE_SIZE,
+    checkpoint: Optional[Checkpoint] = None,
+    score_filter: Optional[ScoreFilter] = None,
+) -> AsyncIterator[tuple[str, list[Score]]]:
+    """Yields (table, scores) for each beatmap's scores, in every table.
+
+    The table is passed along as a score's mode (derived from its mods)
+    doesn't always map back to the table it's stored in."""
+
+    for table in SCORES_TABLES:
+        after_md5 = ""
+
+        if checkpoint is not None:
+            if table in checkpoint.finished_tables:
+                continue
+
+            after_md5 = checkpoint.last_md5s.get(table, "")
+
+        async for score_group in stream_table(
+            table,
+            page_size,
+            after_md5,
+            score_filter,
+        ):
+            yield table, score_group
@@ -1,14 +1,28 @@
 from __future__ import annotations
 
+import time
+from collections import defaultdict
 from typing import NamedTuple
 from typing import Optional
+from typing import Union
+
+import numpy as np
 
 import logger
 import services
+import settings
 import usecases.countries
 from constants.mode import Mode
 from models.stats import Stats
 
+TOP_SCORES = 100
+STAGING_SUFFIX = ":rebuild"  # leaderboards are built under this, then renamed
+
+# WEIGHTS[idx] is the weight of a user's idx-th best score, and ACC_SCALES[n - 1]
+# normalises the weighted accuracy of n scores (the sum of the first n weights)
+WEIGHTS = 0.95 ** np.arange(TOP_SCORES)
+ACC_SCALES = (100.0 / (20 * (1 - 0.95 ** np.arange(1, TOP_SCORES + 1)))) / 100
+
 
 async def fetch(user_id: int, mode: Mode) -> Optional[Stats]:
     db_stats = await services.database.fetch_one(
@@ -68,41 +82,208 @@ async def get_redis_rank(user_id: int, mode: Mode) -> RankInfo:
 
 
 async def full_recalc(stats: Stats) -> None:
+    # the window count is taken before the LIMIT, so it covers all ranked scores
     db_scores = await services.database.fetch_all(
-        f"SELECT s.accuracy, s.pp FROM {stats.mode.scores_table} s RIGHT JOIN beatmaps b USING(beatmap_md5) "
-        "WHERE s.completed = 3 AND s.play_mode = :mode AND b.ranked IN (3, 2) AND s.userid = :id ORDER BY s.pp DESC LIMIT 100",
+        f"SELECT s.accuracy, s.pp, COUNT(*) OVER () ranked_scores FROM {stats.mode.scores_table} s "
+        "INNER JOIN beatmaps b USING(beatmap_md5) "
+        "WHERE s.completed = 3 AND s.play_mode = :mode AND b.ranked IN (3, 2) AND s.userid = :id "
+        f"ORDER BY s.pp DESC LIMIT {TOP_SCORES}",
         {"mode": stats.mode.as_vn, "id": stats.user_id},
     )
 
     logger.debug(f"Got all scores for {stats.user_id} on {stats.mode!r}")
 
+    total_pp, stats.accuracy = weight_scores(
+        [score["pp"] for score in db_scores],
+        [score["accuracy"] for score in db_scores],
+    )
+    ranked_scores = db_scores[0]["ranked_scores"] if db_scores else 0
+
+    stats.pp = total_pp + bonus_pp(ranked_scores)
+
+
+def weight_scores(pps: list[float], accs: list[float]) -> tuple[float, float]:
+    """Returns the weighted pp & accuracy of a user's top scores, best first."""
+
     total_acc = 0.0
     total_pp = 0.0
     last_idx = 0
 
-    for idx, score in enumerate(db_scores):
-        total_pp += score["pp"] * (0.95**idx)
-        total_acc += score["accuracy"] * (0.95**idx)
+    for idx, (pp, acc) in enumerate(zip(pps, accs)):
+        total_pp += pp * (0.95**idx)
+        total_acc += acc * (0.95**idx)
 
         last_idx = idx
 
-    stats.accuracy = (total_acc * (100.0 / (20 * (1 - 0.95 ** (last_idx + 1))))) / 100
-    stats.pp = total_pp + await calc_bonus(stats)
+    return total_pp, (total_acc * (100.0 / (20 * (1 - 0.95 ** (last_idx + 1))))) / 100
+
+
+def weight_many(
+    pp_matrix: np.ndarray,
+    acc_matrix: np.ndarray,
+    top_counts: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Vectorised `weight_scores` for many users at once.
+
+    Each row of the matrices holds one user's top scores, best first,
+    zero-padded to `TOP_SCORES` columns; `top_counts` has how many are real."""
+
+    total_pps = pp_matrix @ WEIGHTS
+    accuracies = (acc_matrix @ WEIGHTS) * ACC_SCALES[np.maximum(top_counts, 1) - 1]
+
+    return total_pps, accuracies
+
+
+def bonus_pp(ranked_scores: Union[int, np.ndarray]) -> Union[float, np.ndarray]:
+    return 416.6667 * (1 - (0.9994**ranked_scores))
+
+
+async def bulk_recalc(
+    table: str,
+    page_size: int = settings.STATS_USERS_PAGE_SIZE,
+) -> dict[Mode, dict[int, tuple[float, float]]]:
+    """Recalculates the pp & accuracy of every user, in every mode stored in
+    `table`, `page_size` users at a time.
+
+    Returns {mode: {user_id: (pp, accuracy)}}."""
+
+    results: dict[Mode, dict[int, tuple[float, float]]] = {}
+
+    for mode in Mode:
+        if mode.scores_table != table:
+            continue
+
+        results[mode] = user_stats = {}
+        last_user_id = 0
+
+        while True:
+            # keyset pagination over users, so each page's window is small
+            user_ids = [
+                row["userid"]
+                for row in await services.database.fetch_all(
+                    f"SELECT DISTINCT userid FROM {table} "
+                    "WHERE completed = 3 AND play_mode = :mode AND userid > :last_user_id "
+                    "ORDER BY userid LIMIT :limit",
+                    {
+                        "mode": mode.as_vn,
+                        "last_user_id": last_user_id,
+                        "limit": page_size,
+                    },
+                )
+            ]
+            if not user_ids:
+                break
+
+            last_user_id = user_ids[-1]
+
+            # only each user's top scores come back, along with their ranked score count
+            db_scores = await services.database.fetch_all(
+                "SELECT userid, pp, accuracy, ranked_scores FROM ("
+                "SELECT s.userid, s.pp, s.accuracy, "
+                "ROW_NUMBER() OVER (PARTITION BY s.userid ORDER BY s.pp DESC) score_rank, "
+                "COUNT(*) OVER (PARTITION BY s.userid) ranked_scores "
+                f"FROM {table} s INNER JOIN beatmaps b USING(beatmap_md5) "
+                "WHERE s.completed = 3 AND b.ranked IN (2, 3) AND s.play_mode = :mode "
+                "AND s.userid BETWEEN :first_user_id AND :last_user_id"
+                ") top_scores WHERE score_rank <= :top_scores "
+                "ORDER BY userid, score_rank",
+                {
+                    "mode": mode.as_vn,
+                    "first_user_id": user_ids[0],
+                    "last_user_id": last_user_id,
+                    "top_scores": TOP_SCORES,
+                },
+            )
+
+            # weigh the whole page at once, as rows of a zero-padded matrix
+            page_user_ids: list[int] = []
+            pp_matrix = np.zeros((len(user_ids), TOP_SCORES))
+            acc_matrix = np.zeros((len(user_ids), TOP_SCORES))
+            top_counts = np.zeros(len(user_ids), dtype=np.int64)
+            ranked_counts = np.zeros(len(user_ids), dtype=np.int64)
+
+            for db_score in db_scores:
+                if not page_user_ids or page_user_ids[-1] != db_score["userid"]:
+                    page_user_ids.append(db_score["userid"])
+
+                idx = len(page_user_ids) - 1
+                pp_matrix[idx, top_counts[idx]] = db_score["pp"]
+                acc_matrix[idx, top_counts[idx]] = db_score["accuracy"]
+                top_counts[idx] += 1
+                ranked_counts[idx] = db_score["ranked_scores"]
+
+            # users without ranked scores are left out, to be zeroed when saved
+            user_count = len(page_user_ids)
+            total_pps, accuracies = weight_many(
+                pp_matrix[:user_count],
+                acc_matrix[:user_count],
+                top_counts[:user_count],
+            )
+            total_pps += bonus_pp(ranked_counts[:user_count])
+
+            user_stats |= zip(
+                page_user_ids,
+                zip(total_pps.tolist(), accuracies.tolist()),
+            )
+
+        logger.info(f"Recalculated {mode!r} stats for {len(user_stats):,} users")
+
+    return results
+
+
+async def save_many(
+    mode: Mode,
+    user_stats: dict[int, tuple[float, float]],
+    batch_size: int,
+    epsilon: float,
+) -> list[int]:
+    """Writes the pp & accuracy of many users in `mode`, zeroing those who no
+    longer have any ranked scores. Rows which haven't changed beyond `epsilon`
+    are left alone.
+
+    Returns the ids of the users which were updated."""
+
+    current = await services.database.fetch_all(
+        f"SELECT id, pp_{mode.stats_prefix} pp, avg_accuracy_{mode.stats_prefix} accuracy "
+        f"FROM {mode.stats_table}",
+    )
 
+    changed: list[tuple[int, float, float]] = []
 
-async def calc_bonus(stats: Stats) -> float:
-    count = await services.database.fetch_val(
-        (
-            f"SELECT COUNT(*) FROM {stats.mode.scores_table} s RIGHT JOIN beatmaps b USING(beatmap_md5) "
-            "WHERE b.ranked IN (2, 3) AND s.completed = 3 AND s.play_mode = :mode AND s.userid = :id LIMIT 25397"
-        ),
-        {
-            "mode": stats.mode.as_vn,
-            "id": stats.user_id,
-        },
+    for row in current:
+        pp, accuracy = user_stats.get(row["id"], (0.0, 0.0))
+
+        if abs(pp - row["pp"]) > epsilon or abs(accuracy - row["accuracy"]) > epsilon:
+            changed.append((row["id"], pp, accuracy))
+
+    for i in range(0, len(changed), batch_size):
+        batch = changed[i : i + batch_size]
+
+        params = {}
+        pp_cases = []
+        acc_cases = []
+
+        for idx, (user_id, pp, accuracy) in enumerate(batch):
+            params[f"id{idx}"] = user_id
+            params[f"pp{idx}"] = pp
+            params[f"acc{idx}"] = accuracy
+            pp_cases.append(f"WHEN :id{idx} THEN :pp{idx}")
+            acc_cases.append(f"WHEN :id{idx} THEN :acc{idx}")
+
+        await services.database.execute(
+            f"UPDATE {mode.stats_table} "
+            f"SET pp_{mode.stats_prefix} = CASE id {' '.join(pp_cases)} END, "
+            f"avg_accuracy_{mode.stats_prefix} = CASE id {' '.join(acc_cases)} END "
+            f"WHERE id IN ({', '.join(f':id{idx}' for idx in range(len(batch)))})",
+            params,
+        )
+
+    logger.info(
+        f"Saved {mode!r} stats for {len(changed):,} users "
+        f"({len(current) - len(changed):,} unchanged)",
     )
 
-    return 416.6667 * (1 - (0.9994**count))
+    return [user_id for user_id, _, _ in changed]
 
 
 async def save(stats: Stats) -> None:
@@ -157,5 +338,159 @@ async def update_rank(stats: Stats) -> None:
     stats.rank, stats.country_rank = await get_redis_rank(stats.user_id, mode)
 
 
+async def fetch_unrestricted_ids() -> set[int]:
+    return {
+        row["id"]
+        for row in await services.database.fetch_all(
+            "SELECT id FROM users WHERE privileges & 1",
+        )
+    }
+
+
+async def update_leaderboards(
+    mode: Mode,
+    user_pps: dict[int, float],
+    chunk_size: int,
+    with_ranks: bool = False,
+) -> dict[int, RankInfo]:
+    """Sets many users' global & country leaderboard pp in `mode`, pipelining
+    one zadd per leaderboard for every `chunk_size` users.
+
+    New ranks are only read back (& returned) if `with_ranks` is set."""
+
+    global_key = f"ripple:{mode.redis_leaderboard}:{mode.stats_prefix}"
+    ranks: dict[int, RankInfo] = {}
+
+    started_at = time.perf_counter()
+    user_ids = list(user_pps)
+
+    for i in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[i : i + chunk_size]
+
+        countries = {
+            user_id: (await usecases.countries.get_country(user_id)).lower()
+            for user_id in chunk
+        }
+
+        country_members: defaultdict[str, dict[str, float]] = defaultdict(dict)
+        for user_id in chunk:
+            country_members[countries[user_id]][str(user_id)] = user_pps[user_id]
+
+        pipe = services.redis.pipeline(transaction=False)
+        pipe.zadd(global_key, {str(user_id): user_pps[user_id] for user_id in chunk})
+
+        for country, members in country_members.items():
+            pipe.zadd(f"{global_key}:{country}", members)
+
+        if with_ranks:
+            for user_id in chunk:
+                pipe.zrevrank(global_key, user_id)
+                pipe.zrevrank(f"{global_key}:{countries[user_id]}", user_id)
+
+        replies = await pipe.execute()
+
+        if with_ranks:
+            rank_replies = replies[1 + len(country_members) :]
+
+            for idx, user_id in enumerate(chunk):
+                global_rank, country_rank = rank_replies[idx * 2 : idx * 2 + 2]
+
+                ranks[user_id] = RankInfo(
+                    int(global_rank) + 1 if global_rank is not None else 0,
+                    int(country_rank) + 1 if country_rank is not None else 0,
+                )
+
+    elapsed = time.perf_counter() - started_at
+    logger.info(
+        f"Updated {mode!r} leaderboards for {len(user_ids):,} users "
+        f"({len(user_ids) / elapsed if elapsed else 0:,.0f} users/s)",
+    )
+
+    return ranks
+
+
+async def rebuild_leaderboards(
+    mode: Mode,
+    user_pps: dict[int, float],
+    chunk_size: int,
+) -> None:
+    """Rebuilds `mode`'s global & country leaderboards from scratch, holding
+    exactly `user_pps`.
+
+    Every leaderboard is written to a staging key first, and then they're all
+    swapped in at once, so players never see a half-updated ranking."""
+
+    global_key = f"ripple:{mode.redis_leaderboard}:{mode.stats_prefix}"
+    staging_keys: set[str] = set()
+
+    started_at = time.perf_counter()
+    user_ids = list(user_pps)
+
+    # left behind by a rebuild which didn't finish
+    stale_staging_keys = [
+        key.decode()
+        async for key in services.redis.scan_iter(
+            match=f"{global_key}*{STAGING_SUFFIX}"
+        )
+    ]
+    if stale_staging_keys:
+        await services.redis.delete(*stale_staging_keys)
+
+    for i in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[i : i + chunk_size]
+
+        country_members: defaultdict[str, dict[str, float]] = defaultdict(dict)
+        for user_id in chunk:
+            country = (await usecases.countries.get_country(user_id)).lower()
+            country_members[country][str(user_id)] = user_pps[user_id]
+
+        pipe = services.redis.pipeline(transaction=False)
+        pipe.zadd(
+            global_key + STAGING_SUFFIX,
+            {str(user_id): user_pps[user_id] for user_id in chunk},
+        )
+        staging_keys.add(global_key + STAGING_SUFFIX)
+
+        for country, members in country_members.items():
+            pipe.zadd(f"{global_key}:{country}{STAGING_SUFFIX}", members)
+            staging_keys.add(f"{global_key}:{country}{STAGING_SUFFIX}")
+
+        await pipe.execute()
+
+    # country leaderboards which no longer have anyone on them
+    live_keys = {global_key} | {
+        key.decode() async for key in services.redis.scan_iter(match=f"{global_key}:??")
+    }
+    stale_keys = live_keys - {key.removesuffix(STAGING_SUFFIX) for key in staging_keys}
+
+    pipe = services.redis.pipeline(transaction=True)
+
+    for key in staging_keys:
+        pipe.rename(key, key.removesuffix(STAGING_SUFFIX))
+
+    if stale_keys:
+        pipe.delete(*stale_keys)
+
+    await pipe.execute()
+
+    elapsed = time.perf_counter() - started_at
+    logger.info(
+        f"Rebuilt {mode!r} leaderboards for {len(user_ids):,} users across "
+        f"{len(staging_keys) - 1 if staging_keys else 0:,} countries in {elapsed:.2f}s",
+    )
+
+
+async def refresh_many(user_ids: list[int], chunk_size: int) -> None:
+    """Pipelined `refresh_stats` for many users."""
+
+    for i in range(0, len(user_ids), chunk_size):
+        pipe = services.redis.pipeline(transaction=False)
+
+        for user_id in user_ids[i : i + chunk_size]:
+            pipe.publish("peppy:update_cached_stats", user_id)
+
+        await pipe.execute()
+
+
 async def refresh_stats(user_id: int) -> None:
     await services.redis.publish("peppy:update_cached_stats", user_id)